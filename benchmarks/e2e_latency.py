@@ -0,0 +1,221 @@
+"""Offline end-to-end latency of the Falcon workflow, with every upstream service faked.
+
+    python benchmarks/e2e_latency.py                         # README queries, default latencies
+    python benchmarks/e2e_latency.py --runs 5 --json out.json
+    python benchmarks/e2e_latency.py --llm-latency 0 --grounding-latency 0   # pure orchestration overhead
+    python benchmarks/e2e_latency.py --session               # the queries as follow-ups in one chat session
+
+The real graph, tools and caches in falcon.py run against the deterministic fakes in
+benchmarks/fakes.py, so the numbers are reproducible and reflect only how the workflow sequences
+its calls. Caches are cleared before each run unless --warm is given; with --session the queries
+are asked in one checkpointed chat session, whose tool results are kept throughout. For every query it reports
+p50/p95 wall time and time to the first streamed token, chat model calls and prompt sizes per
+graph node, tool calls and calls to each upstream service.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Keep the benchmark away from the real NL2SQL cache and from background refresh threads.
+os.environ.setdefault("NL2SQL_CACHE_PATH", os.path.join(tempfile.mkdtemp(prefix="falcon-bench-"), "nl2sql.sqlite3"))
+os.environ["FALCON_WARM_UP"] = "false"
+os.environ.setdefault("CANDLES_PATH", os.path.join(tempfile.mkdtemp(prefix="falcon-bench-"), "candles"))
+os.environ.setdefault("CHECKPOINT_PATH", os.path.join(tempfile.mkdtemp(prefix="falcon-bench-"), "checkpoints.sqlite3"))
+
+from langchain_core.callbacks import BaseCallbackHandler  # noqa: E402
+
+import clients  # noqa: E402
+import fakes  # noqa: E402
+import falcon  # noqa: E402
+import google_grounding  # noqa: E402
+import quotes  # noqa: E402
+import scheduler  # noqa: E402
+import tool_memory  # noqa: E402
+import tracing  # noqa: E402
+
+QUERIES = [
+    "What stocks do I currently hold?",
+    "What's the current price of AAPL?",
+    "Am I making a profit or loss in my portfolio?",
+    "Should I invest in TSLA?",
+    "Should I invest in NVDA?",
+    "Should I sell off my Tesla stocks?",
+    "Are NVDA and TSLA trending up, and how volatile are they?",
+    "What's the current price of NVDA, AAPL and MSFT and should I buy more of them?",
+]
+
+
+class CallCounter(BaseCallbackHandler):
+    """Counts chat model calls and prompt sizes per graph node, and tool calls per tool."""
+
+    def __init__(self):
+        self.model_calls = Counter()
+        self.prompt_chars = Counter()
+        self.max_prompt_chars = Counter()
+        self.tool_calls = Counter()
+
+    def on_chat_model_start(self, serialized, messages, *, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node", "other")
+        chars = sum(len(str(m.content)) + len(json.dumps(getattr(m, "tool_calls", None) or [])) for batch in messages for m in batch)
+        self.model_calls[node] += 1
+        self.prompt_chars[node] += chars
+        self.max_prompt_chars[node] = max(self.max_prompt_chars[node], chars)
+
+    def on_tool_start(self, serialized, input_str, *, name=None, **kwargs):
+        self.tool_calls[name or (serialized or {}).get("name", "unknown")] += 1
+
+
+def reset_caches():
+    quotes.quote_cache.clear()
+    falcon.plan_cache.clear()
+    google_grounding.grounding_cache.clear()
+    shutil.rmtree(clients.get("candle_history").store.root, ignore_errors=True)
+    clients.reset("candle_history")
+    cache = clients.get("nl2sql_cache")
+    cache._conn.execute("DELETE FROM nl2sql")
+    cache._conn.commit()
+
+
+async def run_once(query: str, thread_id: str = None) -> dict:
+    counter = CallCounter()
+    fakes.counts.clear()
+    inputs = {"input": query, "plan": [], "past_steps": None, "step_results": {}, "wave_ok": True, "response": None}
+    config = {"recursion_limit": 50, "callbacks": [counter, *tracing.callbacks()]}
+    if thread_id:
+        config["configurable"] = {"thread_id": thread_id}
+    start = time.perf_counter()
+    first_token = answer = None
+    steps = 0
+    with tool_memory.session(thread_id):
+        async for kind, data in falcon.stream_workflow(inputs, config):
+            if kind in ("step_token", "final_token") and first_token is None:
+                first_token = time.perf_counter() - start
+            elif kind == "step_end":
+                steps += 1
+            elif kind == "final":
+                answer = data
+    if thread_id:
+        await falcon.checkpoints.prune(thread_id)
+    return {
+        "wall_s": time.perf_counter() - start,
+        "first_token_s": first_token,
+        "steps": steps,
+        "answered": bool(answer),
+        "model_calls": dict(counter.model_calls),
+        "prompt_chars": dict(counter.prompt_chars),
+        "max_prompt_chars": dict(counter.max_prompt_chars),
+        "tool_calls": dict(counter.tool_calls),
+        "upstream_calls": dict(fakes.counts),
+    }
+
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    index = (len(values) - 1) * q
+    low = int(index)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (index - low)
+
+
+def summarise(query: str, runs: list) -> dict:
+    walls = [r["wall_s"] for r in runs]
+    first_tokens = [r["first_token_s"] for r in runs if r["first_token_s"] is not None]
+    last = runs[-1]
+    return {
+        "query": query,
+        "runs": len(runs),
+        "p50_s": percentile(walls, 0.5),
+        "p95_s": percentile(walls, 0.95),
+        "first_token_p50_s": percentile(first_tokens, 0.5) if first_tokens else None,
+        "answered": all(r["answered"] for r in runs),
+        # The fakes are deterministic, so the counts of the last run stand for every run.
+        **{key: last[key] for key in ("steps", "model_calls", "prompt_chars", "max_prompt_chars", "tool_calls", "upstream_calls")},
+    }
+
+
+async def bench(queries, runs: int, warm: bool, session: bool = False) -> list:
+    results = []
+    plan_stats = falcon.plan_cache.stats()
+    tool_memory.memory.clear()
+    thread_id = str(uuid.uuid4()) if session else None
+    for query in queries:
+        samples = []
+        for _ in range(runs):
+            if not warm:
+                reset_caches()
+            # Rate limit buckets drained by the previous run would throttle this one.
+            scheduler.reset()
+            samples.append(await run_once(query, thread_id))
+        results.append(summarise(query, samples))
+        stats = falcon.plan_cache.stats()
+        results[-1]["plan_cache_hits"] = stats["hits"] - plan_stats["hits"]
+        plan_stats = stats
+        results[-1]["tool_memory_hits"] = tool_memory.memory.stats()["hits"] - sum(r.get("tool_memory_hits", 0) for r in results[:-1])
+        # Admission counters of the query's last run (the scheduler is reset before every run).
+        results[-1]["scheduler"] = scheduler.stats()
+        if tracing.enabled():
+            # Span totals over all runs of the query: where the time went, per node, tool and upstream call.
+            results[-1]["spans"] = tracing.metrics.summary()
+            tracing.metrics.reset()
+    await falcon.checkpoints.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="runs per query")
+    parser.add_argument("--queries", help="file with one query per line, instead of the README examples")
+    parser.add_argument("--warm", action="store_true", help="keep the quote, grounding and NL2SQL caches between runs")
+    defaults = fakes.Latency()
+    for field in ("llm", "llm_token", "generative", "finnhub", "bigquery", "grounding"):
+        parser.add_argument(f"--{field.replace('_', '-')}-latency", type=float, default=getattr(defaults, field),
+                            dest=field, help=f"seconds per call (default {getattr(defaults, field)})")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--replan-mode", choices=("always", "on_demand"), help="override REPLAN_MODE")
+    parser.add_argument("--trace", action="store_true", help="add span totals per node, tool and upstream call to the results")
+    parser.add_argument("--session", action="store_true", help="ask the queries as follow-ups in one chat session")
+    parser.add_argument("--verbose", action="store_true", help="show what the workflow prints while it runs")
+    args = parser.parse_args()
+
+    queries = QUERIES
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+    latency = fakes.Latency(**{field: getattr(args, field) for field in vars(defaults)})
+    fakes.install(latency)
+    if args.replan_mode:
+        falcon.REPLAN_MODE = args.replan_mode
+    if args.trace:
+        tracing.add_sink(tracing.metrics)
+
+    with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO()):
+        results = asyncio.run(bench(queries, args.runs, args.warm, args.session))
+
+    print(f"{'query':<60} {'p50':>7} {'p95':>7} {'ttft':>7} {'steps':>5} {'llm':>4} {'prompt':>8}")
+    for r in results:
+        ttft = f"{r['first_token_p50_s']:.2f}" if r["first_token_p50_s"] is not None else "n/a"
+        print(f"{r['query'][:60]:<60} {r['p50_s']:>7.2f} {r['p95_s']:>7.2f} {ttft:>7} {r['steps']:>5} "
+              f"{sum(r['model_calls'].values()):>4} {sum(r['prompt_chars'].values()):>8}")
+        print(f"{'':<4}model calls {r['model_calls']}  tools {r['tool_calls']}  upstream {r['upstream_calls']}  plan cache hits {r['plan_cache_hits']}  tool memory hits {r['tool_memory_hits']}")
+        for name, s in r.get("spans", {}).items():
+            print(f"{'':<8}{name:<48} {s['count']:>3}x  mean {s['mean_s']:.2f}s  max {s['max_s']:.2f}s")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"latency": vars(latency), "runs": args.runs, "warm": args.warm, "session": args.session, "replan_mode": falcon.REPLAN_MODE,
+                       "queries": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
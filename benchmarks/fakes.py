@@ -0,0 +1,364 @@
+"""Deterministic offline stand-ins for the upstream services, each with injectable latency.
+
+`install(latency)` swaps them into the client registry (see clients.py), so the real falcon.py
+workflow, tools and caches run unchanged against them.
+"""
+
+import asyncio
+import datetime
+import json
+import re
+import threading
+import zlib
+import time
+from collections import Counter
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolCallChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+import clients
+import scheduler
+from symbols import get_symbol_index
+
+
+@dataclass
+class Latency:
+    """Seconds added to every call of each fake service."""
+    llm: float = 0.5            # chat model, time to first token
+    llm_token: float = 0.0      # chat model, per streamed chunk
+    generative: float = 1.0     # vertexai GenerativeModel.generate_content
+    finnhub: float = 0.15       # one quote request
+    bigquery: float = 1.5       # one query job
+    grounding: float = 2.5      # one grounded generation request
+
+
+HOLDINGS = [
+    ("NVDA", "NVIDIA Corporation", 120, 95.5, datetime.date(2024, 3, 4), "USD"),
+    ("NVDA", "NVIDIA Corporation", 40, 128.0, datetime.date(2024, 8, 19), "USD"),
+    ("TSLA", "Tesla Inc.", 60, 182.25, datetime.date(2024, 5, 2), "USD"),
+    ("AAPL", "Apple Inc.", 100, 171.1, datetime.date(2023, 11, 20), "USD"),
+    ("MSFT", "Microsoft Corporation", 25, 410.0, datetime.date(2024, 1, 15), "USD"),
+]
+
+PRICES = {"NVDA": (131.4, 128.9), "TSLA": (251.7, 247.3), "AAPL": (228.2, 229.0), "MSFT": (418.5, 415.2)}
+
+counts: Counter = Counter()
+_counts_lock = threading.Lock()
+
+
+def count(name: str, n: int = 1):
+    with _counts_lock:
+        counts[name] += n
+
+
+# --- Chat model ---
+
+_TOOL_HINT = re.compile(r"\{?\{?(portfolio_retriever|price_checker|stock_analyser|pnl_calculator|technical_analyser|normal_responder)\}?\}?")
+_TASK = re.compile(r"You are tasked with executing step (\d+), (.*?)(?:\n|$)", re.DOTALL)
+_REMAINING = re.compile(r"Your original plan:\n(.*?)\n\nCompleted steps:", re.DOTALL)
+_PLAN_LINE = re.compile(r"^(\d+)\. (.*?)(?: \(after step ([\d, ]+)\))?$")
+
+
+def remaining_plan(prompt: str) -> list:
+    """Parses the steps still pending from a replanner prompt (as rendered by falcon.format_plan)."""
+    match = _REMAINING.search(prompt)
+    steps = []
+    for line in (match.group(1).splitlines() if match else []):
+        step = _PLAN_LINE.match(line.strip())
+        if step:
+            depends_on = [int(d) for d in step.group(3).split(",")] if step.group(3) else []
+            steps.append({"id": int(step.group(1)), "task": step.group(2), "depends_on": depends_on})
+    return steps
+
+
+def fake_plan(question: str) -> dict:
+    """A plan like the planner prompt asks for, derived from keywords in the question."""
+    symbols = get_symbol_index().resolve(question)
+    q = question.lower()
+    steps = []
+
+    def add(task, depends_on=()):
+        steps.append({"id": len(steps) + 1, "task": task, "depends_on": list(depends_on)})
+        return len(steps)
+
+    if re.search(r"\b(hi|hello|who are you)\b", q) and not symbols:
+        add("Answer the greeting using {{normal_responder}} tool")
+        return {"steps": steps}
+    if re.search(r"\b(profit|loss|sell)\b", q):
+        target = ", ".join(symbols) or "the portfolio"
+        add(f"Calculate the profit or loss of {target} if selling today using {{{{pnl_calculator}}}} tool")
+    elif re.search(r"\b(hold|portfolio|own)\b", q):
+        add("Retrieve the holdings in the portfolio using {{portfolio_retriever}} tool")
+    if "price" in q:
+        for symbol in symbols:
+            add(f"Check the current price of {symbol} using {{{{price_checker}}}} tool")
+    if symbols and re.search(r"\b(trend\w*|volatil\w*|momentum|overbought|oversold|rsi|drawdown)\b", q):
+        add(f"Compute the trend, momentum and risk indicators of {', '.join(symbols)} using {{{{technical_analyser}}}} tool")
+    if re.search(r"\b(invest|buy|sell|should)\b", q):
+        for symbol in symbols:
+            add(f"Analyse how {symbol} is doing in today's market using {{{{stock_analyser}}}} tool")
+    if len(steps) > 1:
+        add("Combine all pieces of information from prior steps to put up a recommendation", range(1, len(steps) + 1))
+    if not steps:
+        add("Answer the question using {{normal_responder}} tool")
+    return {"steps": steps}
+
+
+class UnscheduledFakeChatModel(BaseChatModel):
+    """Stands in for ChatVertexAI: plans, replans and drives the ReAct agent deterministically."""
+
+    latency: Latency = Latency()
+    bound_tools: List[str] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-vertexai"
+
+    def bind_tools(self, tools, tool_choice=None, **kwargs):
+        names = []
+        for t in tools:
+            names.append(getattr(t, "name", None) or getattr(t, "__name__", None) or t.get("title") or t.get("name"))
+        return self.model_copy(update={"bound_tools": names})
+
+    def _respond(self, messages) -> AIMessage:
+        text = str(messages[-1].content)
+        if "Plan" in self.bound_tools:
+            question = str(messages[-1].content)
+            return _tool_call("Plan", fake_plan(question))
+        if "Act" in self.bound_tools:
+            # Like a well-behaved replanner: keep the pending steps, answer once none are left.
+            steps = remaining_plan(text)
+            if steps:
+                return _tool_call("Act", {"plan": {"steps": steps}})
+            summary = " ".join(line.strip() for line in text.splitlines() if line.strip())[-600:]
+            return _tool_call("Act", {"response": {"response": f"Recommendation based on the gathered information: {summary}"}})
+        if self.bound_tools:
+            if messages[-1].type == "tool":
+                return AIMessage(content=f"Here is what I found. {messages[-1].content}")
+            task = _TASK.search(text)
+            task_text = task.group(2) if task else text
+            hint = _TOOL_HINT.search(task_text)
+            if hint and hint.group(1) in self.bound_tools:
+                arg = "qns" if hint.group(1) == "normal_responder" else "prompt"
+                return _tool_call(hint.group(1), {arg: task_text})
+            return AIMessage(content=f"Combining the results: {text[-400:]}")
+        if "Symbols:" in text:
+            return AIMessage(content="[]")
+        return AIMessage(content="I am Falcon, your investment assistant.")
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        count("chat_model")
+        time.sleep(self.latency.llm)
+        return ChatResult(generations=[ChatGeneration(message=self._respond(messages))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        count("chat_model")
+        await asyncio.sleep(self.latency.llm)
+        return ChatResult(generations=[ChatGeneration(message=self._respond(messages))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        count("chat_model")
+        await asyncio.sleep(self.latency.llm)
+        message = self._respond(messages)
+        for chunk in _chunks(message):
+            if run_manager and chunk.content:
+                await run_manager.on_llm_new_token(chunk.content, chunk=ChatGenerationChunk(message=chunk))
+            yield ChatGenerationChunk(message=chunk)
+            await asyncio.sleep(self.latency.llm_token)
+
+
+class FakeChatModel(scheduler.ScheduledChatModel, UnscheduledFakeChatModel):
+    """Like the real model (see tools._chat_model), every call goes through the upstream scheduler."""
+
+
+def _tool_call(name: str, args: dict) -> AIMessage:
+    return AIMessage(content="", tool_calls=[{"name": name, "args": args, "id": f"call_{name}"}])
+
+
+def _chunks(message: AIMessage, size: int = 16):
+    """Splits a message into stream chunks the way a real model emits them."""
+    if message.tool_calls:
+        call = message.tool_calls[0]
+        args = json.dumps(call["args"])
+        for i in range(0, len(args), size):
+            first = i == 0
+            yield AIMessageChunk(content="", tool_call_chunks=[ToolCallChunk(
+                name=call["name"] if first else None, args=args[i:i + size], id=call["id"] if first else None, index=0,
+            )])
+    else:
+        words = message.content.split(" ")
+        for i, word in enumerate(words):
+            yield AIMessageChunk(content=word if i == len(words) - 1 else word + " ")
+
+
+# --- Google SDK stand-ins ---
+
+class FakeGenerativeModel:
+    """vertexai GenerativeModel: writes SQL when asked for it, otherwise summarises."""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+
+    def generate_content(self, prompt: str):
+        count("generative_model")
+        count("generative_model_prompt_chars", len(prompt))
+        time.sleep(self.latency.generative)
+        if prompt.startswith("Use these System Instructions"):
+            return SimpleNamespace(text="SELECT symbol, company_name, quantity, purchase_price, purchase_date, currency FROM `fake.portfolio.holdings`")
+        return SimpleNamespace(text=f"Summary: {prompt[-300:]}")
+
+
+class FakeBigQueryClient:
+    def __init__(self, latency: Latency):
+        self.latency = latency
+
+    def query(self, sql: str, job_config=None):
+        count("bigquery")
+        time.sleep(self.latency.bigquery)
+        parameters = {p.name: getattr(p, "values", None) or getattr(p, "value", None) for p in getattr(job_config, "query_parameters", None) or []}
+        rows = [
+            dict(zip(("symbol", "company_name", "quantity", "purchase_price", "purchase_date", "currency"), row))
+            for row in HOLDINGS
+        ]
+        if "symbols" in parameters:
+            rows = [row for row in rows if row["symbol"] in parameters["symbols"]]
+        if "watermark" in parameters:
+            rows = [row for row in rows if row["purchase_date"] >= parameters["watermark"]]
+        return SimpleNamespace(result=lambda: rows)
+
+
+class FakeGroundingClient:
+    """GroundedGenerationServiceClient returning a small grounded answer with one citation."""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+
+    def common_location_path(self, project, location):
+        return f"projects/{project}/locations/{location}"
+
+    def generate_grounded_content(self, request):
+        from google.cloud import discoveryengine_v1 as discoveryengine
+
+        count("grounding")
+        time.sleep(self.latency.grounding)
+        prompt = request.contents[0].parts[0].text
+        response = discoveryengine.GenerateGroundedContentResponse
+        return response(candidates=[response.Candidate(
+            content=discoveryengine.GroundedGenerationContent(
+                role="model",
+                parts=[discoveryengine.GroundedGenerationContent.Part(text=f"Recent news is mixed for: {prompt[:200]}")],
+            ),
+            grounding_metadata=response.Candidate.GroundingMetadata(support_chunks=[
+                discoveryengine.FactChunk(chunk_text="Analysts expect volatility.", source_metadata={"title": "Market wrap", "uri": "https://example.com/wrap"}),
+            ]),
+        )])
+
+
+class FakeQuoteClient:
+    """quotes.QuoteClient: one latency per batch, since the real client fetches a batch in parallel."""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+
+    def _quotes(self, symbols) -> Dict[str, Any]:
+        symbols = list(symbols)
+        count("finnhub_quotes", len(symbols))
+        return {s: {"c": PRICES[s][0], "pc": PRICES[s][1]} if s in PRICES else {"c": 0, "pc": 0} for s in symbols}
+
+    def quotes(self, symbols, timeout: Optional[float] = None):
+        time.sleep(self.latency.finnhub)
+        return self._quotes(symbols)
+
+    async def aquotes(self, symbols, timeout: Optional[float] = None):
+        await asyncio.sleep(self.latency.finnhub)
+        return self._quotes(symbols)
+
+    def candles(self, symbol: str, start: int, end: int, resolution: str = "D", timeout: Optional[float] = None):
+        """Weekday candles of a smooth, symbol-dependent cycle around its PRICES price, with an upward drift."""
+        time.sleep(self.latency.finnhub)
+        count("finnhub_candles")
+        if symbol not in PRICES:
+            return {"s": "no_data"}
+        days = np.arange(start // 86400 + (start % 86400 > 0), end // 86400 + 1)
+        days = days[(days + 3) % 7 < 5]  # 1970-01-01 was a Thursday
+        if not len(days):
+            return {"s": "no_data"}
+        # Each close is a fixed function of the symbol and day, so incremental fetches continue the series.
+        phase = zlib.crc32(symbol.encode()) % 97
+        close = PRICES[symbol][0] * np.exp(0.12 * np.sin((days + phase) / 23) + 0.04 * np.sin((days + phase) / 5.3) + 0.0008 * (days - 20000))
+        return {"s": "ok", "t": (days * 86400).tolist(), "o": (close * 0.995).tolist(), "h": (close * 1.01).tolist(),
+                "l": (close * 0.99).tolist(), "c": close.tolist(), "v": [1e6] * len(days)}
+
+
+def install(latency: Latency):
+    """Replaces every upstream client in the registry with its fake."""
+    clients.override("chat_llm", FakeChatModel(latency=latency))
+    clients.override("sql_generator", FakeGenerativeModel(latency))
+    clients.override("grounding_model", FakeGenerativeModel(latency))
+    clients.override("bigquery", FakeBigQueryClient(latency))
+    clients.override("grounding_search", FakeGroundingClient(latency))
+    clients.override("quotes", FakeQuoteClient(latency))
+    # Chains built on the real model must be rebuilt on the fake one.
+    for name in ("agent_executor", "planner", "replanner", "holdings_snapshot", "candle_history"):
+        clients.reset(name)
+
+
+class FakeTradeFeed:
+    """Local stand-in for the Finnhub trade websocket: streams a random walk of PRICES for subscribed symbols.
+
+    `url` is ready once `start()` returns; point PRICE_FEED_URL at it.
+    """
+
+    def __init__(self, interval: float = 0.05, host: str = "127.0.0.1", port: int = 0):
+        self.interval = interval
+        self.host = host
+        self.port = port
+        self.url = None
+        self.prices = {symbol: price for symbol, (price, _) in PRICES.items()}
+        self._ready = threading.Event()
+
+    async def _handler(self, ws):
+        import random
+
+        subscribed = set()
+
+        async def receive():
+            async for message in ws:
+                data = json.loads(message)
+                if data.get("type") == "subscribe":
+                    subscribed.add(data["symbol"])
+                elif data.get("type") == "unsubscribe":
+                    subscribed.discard(data["symbol"])
+
+        receiver = asyncio.ensure_future(receive())
+        try:
+            while not receiver.done():
+                trades = []
+                for symbol in list(subscribed):
+                    if symbol in self.prices:
+                        self.prices[symbol] = round(self.prices[symbol] * (1 + random.uniform(-0.001, 0.001)), 2)
+                        trades.append({"s": symbol, "p": self.prices[symbol], "t": int(time.time() * 1000), "v": 100})
+                if trades:
+                    await ws.send(json.dumps({"type": "trade", "data": trades}))
+                await asyncio.sleep(self.interval)
+        finally:
+            receiver.cancel()
+
+    def start(self):
+        import websockets
+
+        async def serve():
+            async with websockets.serve(self._handler, self.host, self.port) as server:
+                port = next(iter(server.sockets)).getsockname()[1]
+                self.url = f"ws://{self.host}:{port}"
+                self._ready.set()
+                await asyncio.Future()
+
+        threading.Thread(target=lambda: asyncio.run(serve()), name="fake-trade-feed", daemon=True).start()
+        self._ready.wait(5)
+        return self
@@ -0,0 +1,94 @@
+"""Measures worker cold start: the time to import falcon.py in a fresh interpreter.
+
+    python benchmarks/import_time.py                      # lazy import, then import + eager warm-up
+    python benchmarks/import_time.py --baseline-ref HEAD~1 # also measure another revision
+
+Each measurement runs in a new process so nothing is cached between runs. The eager run builds
+every registered client, which needs credentials; failures are reported but still timed, since
+they show how long a worker would block before it could serve anything.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LAZY = "import falcon"
+EAGER = "import falcon, clients; assert len(clients.warm_up(background=False)) == len(clients.names())"
+TIMER = """
+import time
+start = time.perf_counter()
+try:
+    exec({code!r})
+    ok = True
+except Exception as e:
+    ok = False
+print("__elapsed__", time.perf_counter() - start, ok)
+"""
+
+
+def measure(code: str, cwd: str, runs: int) -> dict:
+    timings, failures = [], 0
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", TIMER.format(code=code)],
+            cwd=cwd, capture_output=True, text=True, env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+        )
+        line = next((l for l in result.stdout.splitlines() if l.startswith("__elapsed__")), None)
+        if line is None:
+            # The interpreter died before the timer could report, e.g. an import-time credentials error.
+            failures += 1
+            continue
+        _, elapsed, ok = line.split()
+        timings.append(float(elapsed))
+        failures += ok != "True"
+    return {
+        "runs": runs,
+        "failures": failures,
+        "median_s": statistics.median(timings) if timings else None,
+        "min_s": min(timings) if timings else None,
+    }
+
+
+def checkout(ref: str) -> str:
+    """Extracts the tree of a git revision into a temporary directory."""
+    target = tempfile.mkdtemp(prefix="falcon-import-")
+    archive = subprocess.run(["git", "archive", "--format=tar", ref], cwd=ROOT, capture_output=True, check=True).stdout
+    path = os.path.join(target, "tree.tar")
+    with open(path, "wb") as f:
+        f.write(archive)
+    with tarfile.open(path) as tar:
+        tar.extractall(target)
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--baseline-ref", help="git revision to compare against, e.g. the commit before lazy clients")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = {
+        "lazy_import": measure(LAZY, ROOT, args.runs),
+        "import_and_warm_up": measure(EAGER, ROOT, args.runs),
+    }
+    if args.baseline_ref:
+        results[f"baseline_import@{args.baseline_ref}"] = measure(LAZY, checkout(args.baseline_ref), args.runs)
+
+    for name, result in results.items():
+        median = f"{result['median_s']:.3f}s" if result["median_s"] is not None else "n/a"
+        print(f"{name:<32} median {median}  ({result['failures']}/{result['runs']} failed)")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
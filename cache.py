@@ -0,0 +1,150 @@
+#In-process caches shared by the tools
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe, size-bounded LRU cache whose entries go stale after `ttl` seconds.
+
+    `get_many` coalesces concurrent loads: while a key is being fetched, other callers asking
+    for it wait for that fetch instead of starting their own (single-flight).
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._inflight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "coalesced": 0, "loads": 0, "evictions": 0}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _lookup(self, key: Hashable) -> Any:
+        # Must be called with the lock held.
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISSING
+        value, stored_at = entry
+        if self.clock() - stored_at > self.ttl:
+            self._stats["stale"] += 1
+            del self._data[key]
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            value = self._lookup(key)
+            self._stats["hits" if value is not _MISSING else "misses"] += 1
+        return default if value is _MISSING else value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key: Hashable, value: Any):
+        self._data[key] = (value, self.clock())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _claim(self, keys: Iterable[Hashable]):
+        """Splits keys into cached values, loads already in flight and keys this caller must load."""
+        found, waiting, owned = {}, {}, {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                value = self._lookup(key)
+                if value is not _MISSING:
+                    self._stats["hits"] += 1
+                    found[key] = value
+                elif key in self._inflight:
+                    self._stats["coalesced"] += 1
+                    waiting[key] = self._inflight[key]
+                else:
+                    self._stats["misses"] += 1
+                    owned[key] = self._inflight[key] = Future()
+        return found, waiting, owned
+
+    def _settle(self, owned: Dict[Hashable, Future], loaded: Any, found: Dict[Hashable, Any]):
+        """Stores freshly loaded values and releases the callers waiting on them.
+
+        A key the loader failed on (an exception value, or a missing key) is handed to the
+        waiters but not cached.
+        """
+        with self._lock:
+            self._stats["loads"] += 1
+            for key, future in owned.items():
+                if isinstance(loaded, Exception):
+                    value = loaded
+                else:
+                    value = loaded.get(key, KeyError(key))
+                if not isinstance(value, Exception):
+                    self._store(key, value)
+                del self._inflight[key]
+                future.set_result(value)
+                found[key] = value
+
+    def get_many(self, keys: Iterable[Hashable], load_many: Callable[[List[Hashable]], Dict[Hashable, Any]]) -> Dict[Hashable, Any]:
+        """Returns a value for every key, loading the missing ones with a single `load_many` call.
+
+        `load_many` may map a key to an exception to report a per-key failure.
+        """
+        keys = list(keys)
+        found, waiting, owned = self._claim(keys)
+        if owned:
+            loaded: Any = RuntimeError("The load was interrupted")
+            try:
+                loaded = load_many(list(owned))
+            except Exception as e:
+                loaded = e
+            finally:
+                # Always release the waiters, even if this caller is cancelled mid-load.
+                self._settle(owned, loaded, found)
+        for key, future in waiting.items():
+            found[key] = future.result()
+        return {key: found[key] for key in dict.fromkeys(keys)}
+
+    async def aget_many(self, keys: Iterable[Hashable], load_many: Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]]) -> Dict[Hashable, Any]:
+        """Async variant of `get_many`; it shares in-flight loads with synchronous callers."""
+        keys = list(keys)
+        found, waiting, owned = self._claim(keys)
+        if owned:
+            loaded: Any = RuntimeError("The load was interrupted")
+            try:
+                loaded = await load_many(list(owned))
+            except Exception as e:
+                loaded = e
+            finally:
+                # Always release the waiters, even if this caller is cancelled mid-load.
+                self._settle(owned, loaded, found)
+        for key, future in waiting.items():
+            found[key] = await asyncio.wrap_future(future)
+        return {key: found[key] for key in dict.fromkeys(keys)}
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the hit/miss/staleness counters and the current hit rate."""
+        with self._lock:
+            stats = dict(self._stats, size=len(self._data))
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = (stats["hits"] + stats["coalesced"]) / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,212 @@
+#Local daily OHLCV history in memory-mapped column files, appended to incrementally from Finnhub or CSV
+
+import contextvars
+import csv
+import datetime
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+import clients
+from config import CANDLES_LOOKBACK_DAYS, CANDLES_PATH, CANDLES_REFRESH_SECONDS
+
+
+COLUMNS = ("t", "o", "h", "l", "c", "v")
+_DTYPES = {"t": np.int64, "o": np.float64, "h": np.float64, "l": np.float64, "c": np.float64, "v": np.float64}
+_CSV_COLUMNS = {
+    "t": "t", "date": "t", "time": "t", "timestamp": "t",
+    "o": "o", "open": "o", "h": "h", "high": "h", "l": "l", "low": "l",
+    "c": "c", "close": "c", "v": "v", "volume": "v",
+}
+
+
+class CandleStore:
+    """Candles per symbol, one memory-mapped file per column.
+
+    Layout: `<root>/<SYMBOL>/<column>.bin`, each a raw array in time order (`t` in epoch seconds
+    as int64, prices and volume as float64). Appends only add rows newer than the last stored
+    one, and overwrite the last one, which may be a candle of a day still trading, when it comes
+    again; ingesting overlapping ranges again is harmless. Reads map the files rather than load
+    them, so only the rows touched are paged in. If a write is interrupted between columns, reads
+    use the shortest column and the next append trims the others.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _path(self, symbol: str, column: str) -> str:
+        return os.path.join(self.root, re.sub(r"[^A-Z0-9._-]", "_", symbol.upper()), f"{column}.bin")
+
+    def symbols(self) -> List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if self.length(name))
+
+    def length(self, symbol: str) -> int:
+        """Number of complete rows stored for the symbol."""
+        sizes = []
+        for column in COLUMNS:
+            path = self._path(symbol, column)
+            sizes.append(os.path.getsize(path) // np.dtype(_DTYPES[column]).itemsize if os.path.exists(path) else 0)
+        return min(sizes)
+
+    def _map(self, symbol: str, column: str, n: int) -> np.ndarray:
+        if n == 0:
+            return np.empty(0, dtype=_DTYPES[column])
+        return np.memmap(self._path(symbol, column), dtype=_DTYPES[column], mode="r", shape=(n,))
+
+    def read(self, symbol: str, last: Optional[int] = None) -> Dict[str, np.ndarray]:
+        """Columns of the symbol, oldest first; only the latest `last` rows if given."""
+        n = self.length(symbol)
+        start = max(n - last, 0) if last else 0
+        return {column: self._map(symbol, column, n)[start:] for column in COLUMNS}
+
+    def last_time(self, symbol: str) -> Optional[int]:
+        t = self.read(symbol, last=1)["t"]
+        return int(t[-1]) if len(t) else None
+
+    def append(self, symbol: str, candles: Dict[str, Iterable]) -> int:
+        """Adds the candles newer than the stored ones and replaces the last stored one; returns how many were written."""
+        t = np.asarray(candles["t"], dtype=np.int64)
+        # A missing column (e.g. a CSV without volume) is stored as NaN.
+        arrays = {"t": t, **{
+            column: np.asarray(candles[column], dtype=np.float64) if column in candles and len(candles[column]) else np.full(len(t), np.nan)
+            for column in COLUMNS[1:]
+        }}
+        # Sorted by time, one candle per timestamp.
+        _, first = np.unique(arrays["t"], return_index=True)
+        with self._lock:
+            last = self.last_time(symbol)
+            n = self.length(symbol)
+            if last is not None:
+                first = first[arrays["t"][first] >= last]
+            if not len(first):
+                return 0
+            if arrays["t"][first[0]] == last:
+                n -= 1
+            os.makedirs(os.path.dirname(self._path(symbol, "t")), exist_ok=True)
+            for column in COLUMNS:
+                with open(self._path(symbol, column), "ab") as f:
+                    f.truncate(n * np.dtype(_DTYPES[column]).itemsize)
+                    arrays[column][first].tofile(f)
+        return len(first)
+
+    def closes(self, symbols: List[str], length: int) -> Tuple[np.ndarray, np.ndarray]:
+        """The latest `length` closes of each symbol as one (symbols x days) matrix, and each symbol's last time.
+
+        Rows are aligned on their latest candle and padded with NaN at the front, which lines up
+        daily candles of symbols trading on the same exchange.
+        """
+        matrix = np.full((len(symbols), length), np.nan)
+        last_times = np.zeros(len(symbols), dtype=np.int64)
+        for i, symbol in enumerate(symbols):
+            columns = self.read(symbol, last=length)
+            n = len(columns["c"])
+            if n:
+                matrix[i, length - n:] = columns["c"]
+                last_times[i] = columns["t"][-1]
+        return matrix, last_times
+
+    def ingest_csv(self, path: str, symbol: Optional[str] = None) -> Dict[str, int]:
+        """Appends the candles of a CSV file, e.g. a fixture or a bulk export.
+
+        Recognised headers (any case): date/time/timestamp, open, high, low, close, volume and
+        optionally symbol. Without a symbol column the rows belong to `symbol`, or to the file name
+        (`NVDA.csv`). Times are ISO dates or datetimes (UTC), or epoch seconds.
+        """
+        default = (symbol or os.path.splitext(os.path.basename(path))[0]).upper()
+        rows: Dict[str, Dict[str, list]] = defaultdict(lambda: {column: [] for column in COLUMNS})
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                fields = {k.strip().lower(): v for k, v in row.items() if k}
+                target = rows[(fields.get("symbol") or default).strip().upper()]
+                for header, column in _CSV_COLUMNS.items():
+                    if header in fields:
+                        target[column].append(_parse_time(fields[header]) if column == "t" else float(fields[header] or "nan"))
+        return {s: self.append(s, candles) for s, candles in rows.items()}
+
+
+def _parse_time(value: str) -> int:
+    value = value.strip()
+    if re.fullmatch(r"\d+", value):
+        # Epoch milliseconds are too large to be seconds.
+        return int(value) // 1000 if int(value) > 10**11 else int(value)
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return int(parsed.timestamp())
+
+
+class CandleHistory:
+    """Keeps a `CandleStore` up to date from Finnhub `/stock/candle`, fetching only what each symbol is missing.
+
+    `client` is anything with `candles(symbol, start, end)` returning Finnhub's response
+    (`{"s": "ok", "t": [...], "o": [...], ...}` or `{"s": "no_data"}`), so a local fake works for
+    tests. New symbols get `lookback_days` of history; known ones are fetched from their last
+    stored candle. A symbol is refreshed at most once per `refresh_seconds`; if its fetch fails
+    it is served from what the store already has.
+    """
+
+    def __init__(self, store: CandleStore, client, lookback_days: int = 400, refresh_seconds: float = 3600,
+                 max_workers: int = 8, clock=time.time):
+        self.store = store
+        self.client = client
+        self.lookback_days = lookback_days
+        self.refresh_seconds = refresh_seconds
+        self.max_workers = max_workers
+        self.clock = clock
+        self._refreshed: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _fetch(self, symbol: str, end: int) -> int:
+        last = self.store.last_time(symbol)
+        # From the last stored candle on, so one fetched while its day was still trading is corrected.
+        start = last if last is not None else end - self.lookback_days * 86400
+        data = self.client.candles(symbol, start, end)
+        if data.get("s") != "ok":
+            return 0
+        return self.store.append(symbol, data)
+
+    def refresh(self, symbols: Iterable[str]) -> Dict[str, Exception]:
+        """Fetches the new candles of the symbols that are due, concurrently; returns the failures."""
+        now = self.clock()
+        with self._lock:
+            due = [s for s in dict.fromkeys(symbols) if now - self._refreshed.get(s, float("-inf")) >= self.refresh_seconds]
+            for symbol in due:
+                self._refreshed[symbol] = now
+        if not due:
+            return {}
+        errors = {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(due)), thread_name_prefix="candles") as executor:
+            # Each fetch runs in a copy of the caller's context so its span nests under the caller's.
+            futures = {symbol: executor.submit(contextvars.copy_context().run, self._fetch, symbol, int(now)) for symbol in due}
+            for symbol, future in futures.items():
+                try:
+                    added = future.result()
+                    if added:
+                        print(f"Stored {added} candles for {symbol}")
+                except Exception as e:
+                    errors[symbol] = e
+                    with self._lock:
+                        self._refreshed.pop(symbol, None)
+        return errors
+
+    def closes(self, symbols: List[str], length: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Refreshes the symbols, then returns `CandleStore.closes`."""
+        errors = self.refresh(symbols)
+        for symbol, error in errors.items():
+            print(f"Could not refresh the candles of {symbol}: {error}")
+        return self.store.closes(symbols, length)
+
+
+clients.register(
+    "candle_history",
+    lambda: CandleHistory(CandleStore(CANDLES_PATH), clients.get("quotes"), CANDLES_LOOKBACK_DAYS, CANDLES_REFRESH_SECONDS),
+)
@@ -0,0 +1,59 @@
+#Chat session state kept across turns, and restarts, in a local SQLite database
+
+import asyncio
+import os
+from typing import Optional
+
+from config import CHECKPOINT_PATH
+
+
+_saver = None
+_saver_lock = asyncio.Lock()
+
+
+async def get_saver():
+    """Returns the shared SQLite checkpointer, opening the database on first use.
+
+    The saver is bound to the event loop it is created on, so it is built from async code rather
+    than at import time. None when CHECKPOINT_PATH is empty.
+    """
+    global _saver
+    if _saver is None and CHECKPOINT_PATH:
+        async with _saver_lock:
+            if _saver is None:
+                import aiosqlite
+                from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+                if os.path.dirname(CHECKPOINT_PATH):
+                    os.makedirs(os.path.dirname(CHECKPOINT_PATH), exist_ok=True)
+                saver = AsyncSqliteSaver(aiosqlite.connect(CHECKPOINT_PATH, check_same_thread=False))
+                await saver.setup()
+                _saver = saver
+    return _saver
+
+
+async def close():
+    """Closes the database; its connection thread would otherwise keep the process alive."""
+    global _saver
+    if _saver is not None:
+        await _saver.conn.close()
+        _saver = None
+
+
+async def prune(thread_id: str, keep: int = 1, saver: Optional[object] = None):
+    """Drops all but the latest `keep` checkpoints of a session, and those of the agent runs inside it.
+
+    Only the state at the end of a turn is read back, so older checkpoints just grow the file.
+    """
+    saver = saver or _saver
+    if saver is None:
+        return
+    async with saver.lock:
+        for table in ("writes", "checkpoints"):
+            await saver.conn.execute(
+                f"""DELETE FROM {table} WHERE thread_id = ? AND (checkpoint_ns != '' OR checkpoint_id NOT IN (
+                    SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ''
+                    ORDER BY checkpoint_id DESC LIMIT ?))""",
+                (thread_id, thread_id, keep),
+            )
+        await saver.conn.commit()
@@ -0,0 +1,85 @@
+#Registry of the upstream clients, built on first use and shared by every chat session
+
+import asyncio
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+
+_factories: Dict[str, Callable[[], Any]] = {}
+_clients: Dict[str, Any] = {}
+_locks: Dict[str, threading.Lock] = {}
+
+
+def register(name: str, factory: Callable[[], Any]):
+    """Declares how to build a client; nothing is built (or imported) until `get` is called."""
+    _factories[name] = factory
+    _locks.setdefault(name, threading.Lock())
+
+
+def names() -> List[str]:
+    """Names of the registered clients."""
+    return list(_factories)
+
+
+def get(name: str) -> Any:
+    """Returns the shared client, building it on first use."""
+    client = _clients.get(name)
+    if client is not None:
+        return client
+    if name not in _factories:
+        raise KeyError(f"No client registered under '{name}'")
+    with _locks[name]:
+        if name not in _clients:
+            _clients[name] = _factories[name]()
+        return _clients[name]
+
+
+async def aget(name: str) -> Any:
+    """Async variant of `get`; a client not built yet is built on a worker thread so the event loop keeps running."""
+    client = _clients.get(name)
+    if client is not None:
+        return client
+    return await asyncio.to_thread(get, name)
+
+
+def override(name: str, client: Any):
+    """Replaces a client, e.g. with a local fake in tests and benchmarks."""
+    _locks.setdefault(name, threading.Lock())
+    _clients[name] = client
+
+
+def reset(name: Optional[str] = None):
+    """Drops built clients so the next `get` rebuilds them."""
+    if name is None:
+        _clients.clear()
+    else:
+        _clients.pop(name, None)
+
+
+def warm_up(names: Optional[Iterable[str]] = None, background: bool = True) -> Dict[str, float]:
+    """Builds the clients ahead of the first request, in parallel.
+
+    With `background` the call returns immediately and the clients are built on daemon threads;
+    otherwise it waits and returns how long each client took to build.
+    """
+    timings: Dict[str, float] = {}
+
+    def build(name: str):
+        start = time.perf_counter()
+        try:
+            get(name)
+            timings[name] = time.perf_counter() - start
+        except Exception as e:
+            print(f"Warm-up of client '{name}' failed: {e}")
+
+    threads = [
+        threading.Thread(target=build, args=(name,), name=f"warm-up-{name}", daemon=True)
+        for name in (list(names) if names is not None else list(_factories))
+    ]
+    for thread in threads:
+        thread.start()
+    if not background:
+        for thread in threads:
+            thread.join()
+    return timings
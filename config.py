@@ -1,3 +1,4 @@
+import json
 import os
 
 LLM_MODEL = "gemini-1.5-flash-002"
@@ -7,3 +8,87 @@ PROJECT_ID = os.getenv("GCP_PROJECT_ID")
 BIGQUERY_DATASET_ID = os.getenv("GCP_BIGQUERY_DATASET_ID")
 FINNHUB_API_KEY = os.getenv("FINNHUB_API_KEY") 
 
+MAX_PARALLEL_STEPS = int(os.getenv("FALCON_MAX_PARALLEL_STEPS", "4"))
+
+FINNHUB_BASE_URL = os.getenv("FINNHUB_BASE_URL", "https://finnhub.io/api/v1")
+QUOTE_MAX_WORKERS = int(os.getenv("QUOTE_MAX_WORKERS", "8"))
+QUOTE_TIMEOUT = float(os.getenv("QUOTE_TIMEOUT", "5"))
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", "15"))
+QUOTE_CACHE_SIZE = int(os.getenv("QUOTE_CACHE_SIZE", "1024"))
+SYMBOL_LISTING_PATH = os.getenv("SYMBOL_LISTING_PATH")
+
+NL2SQL_CACHE_PATH = os.getenv("NL2SQL_CACHE_PATH", os.path.join(".falcon_cache", "nl2sql.sqlite3"))
+NL2SQL_CACHE_SIZE = int(os.getenv("NL2SQL_CACHE_SIZE", "512"))
+
+HOLDINGS_SNAPSHOT = os.getenv("HOLDINGS_SNAPSHOT", "false").lower() in ("1", "true", "yes")
+HOLDINGS_REFRESH_SECONDS = float(os.getenv("HOLDINGS_REFRESH_SECONDS", "300"))
+HOLDINGS_FULL_REFRESH_SECONDS = float(os.getenv("HOLDINGS_FULL_REFRESH_SECONDS", "3600"))
+
+BASE_CURRENCY = os.getenv("BASE_CURRENCY", "USD")
+# Units of BASE_CURRENCY per unit of each currency, e.g. {"EUR": 1.08, "SGD": 0.74}
+FX_RATES = json.loads(os.getenv("FX_RATES", "{}"))
+
+# How long a grounded analysis is reused; cache keys fall into buckets of this many seconds
+GROUNDING_CACHE_BUCKET_SECONDS = float(os.getenv("GROUNDING_CACHE_BUCKET_SECONDS", "900"))
+GROUNDING_CACHE_SIZE = int(os.getenv("GROUNDING_CACHE_SIZE", "256"))
+# full: rewrite the raw grounded response, text: rewrite only its text and citations, none: return the grounded answer as is
+GROUNDING_REWRITE = os.getenv("GROUNDING_REWRITE", "text")
+
+# Build the model and service clients on background threads at startup instead of on the first request
+WARM_UP_CLIENTS = os.getenv("FALCON_WARM_UP", "false").lower() in ("1", "true", "yes")
+
+# Comma-separated tracing sinks: metrics (Prometheus-style, served on FALCON_METRICS_PORT if set) and/or json (one span per line)
+TRACING_SINKS = [s.strip() for s in os.getenv("FALCON_TRACING", "").lower().split(",") if s.strip()]
+TRACE_LOG_PATH = os.getenv("FALCON_TRACE_LOG", os.path.join(".falcon_cache", "traces.jsonl"))
+METRICS_PORT = int(os.getenv("FALCON_METRICS_PORT", "0"))
+
+# Replanner context: token budget for the completed steps, how many of the latest results are sent verbatim and how long older ones may be
+REPLAN_CONTEXT_TOKENS = int(os.getenv("REPLAN_CONTEXT_TOKENS", "2000"))
+REPLAN_KEEP_RECENT_STEPS = int(os.getenv("REPLAN_KEEP_RECENT_STEPS", "2"))
+REPLAN_OLDER_STEP_CHARS = int(os.getenv("REPLAN_OLDER_STEP_CHARS", "400"))
+
+# always: replan after every wave of steps; on_demand: go straight to the next planned steps and only replan after a failed or empty step, or once the plan is done
+REPLAN_MODE = os.getenv("REPLAN_MODE", "always").lower()
+
+# Reuse the plan of an earlier question of the same shape (same words, other companies) instead of calling the planner
+PLAN_CACHE = os.getenv("PLAN_CACHE", "true").lower() in ("1", "true", "yes")
+PLAN_CACHE_SIZE = int(os.getenv("PLAN_CACHE_SIZE", "256"))
+# Optional JSON file to keep the plan cache across restarts
+PLAN_CACHE_PATH = os.getenv("PLAN_CACHE_PATH")
+
+# Upstream admission control shared by every chat session (see scheduler.py)
+SCHEDULER_ENABLED = os.getenv("FALCON_SCHEDULER", "true").lower() in ("1", "true", "yes")
+# Per-service overrides, e.g. {"finnhub": {"rate": 5, "burst": 60, "concurrency": 8}}
+SCHEDULER_LIMITS = json.loads(os.getenv("SCHEDULER_LIMITS", "{}"))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "100"))
+SCHEDULER_MAX_WAIT = float(os.getenv("SCHEDULER_MAX_WAIT", "60"))
+
+# Stream trades of held and recently requested symbols into an in-memory price book, read before Finnhub REST
+PRICE_FEED = os.getenv("PRICE_FEED", "false").lower() in ("1", "true", "yes")
+PRICE_FEED_URL = os.getenv("PRICE_FEED_URL", "wss://ws.finnhub.io")
+PRICE_FEED_WATCH_LIMIT = int(os.getenv("PRICE_FEED_WATCH_LIMIT", "50"))
+# A streamed price is used for this long after its last trade, or as long as its subscription is live
+PRICE_FEED_MAX_AGE = float(os.getenv("PRICE_FEED_MAX_AGE", "60"))
+# The previous close comes from REST and is refetched after this many seconds
+PRICE_FEED_PREV_CLOSE_MAX_AGE = float(os.getenv("PRICE_FEED_PREV_CLOSE_MAX_AGE", "21600"))
+
+# Chat session state (plan, step results, earlier turns) checkpointed per session in this SQLite file; empty keeps nothing between turns
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", os.path.join(".falcon_cache", "checkpoints.sqlite3"))
+# Earlier questions and answers of the session shown to the planner, so follow-ups like "and what about Tesla?" make sense
+SESSION_HISTORY_TURNS = int(os.getenv("SESSION_HISTORY_TURNS", "3"))
+
+# Reuse the results of earlier tool calls of the same session while they are fresh (see tool_memory.py)
+TOOL_MEMORY = os.getenv("TOOL_MEMORY", "true").lower() in ("1", "true", "yes")
+# Seconds a result stays fresh per tool, 0 to never reuse it, e.g. {"price_checker": 0, "stock_analyser": 1800}
+TOOL_MEMORY_TTLS = json.loads(os.getenv("TOOL_MEMORY_TTLS", "{}"))
+# Per session: most results kept and their total size in characters; and most sessions kept
+TOOL_MEMORY_MAX_ENTRIES = int(os.getenv("TOOL_MEMORY_MAX_ENTRIES", "64"))
+TOOL_MEMORY_MAX_CHARS = int(os.getenv("TOOL_MEMORY_MAX_CHARS", "200000"))
+TOOL_MEMORY_MAX_SESSIONS = int(os.getenv("TOOL_MEMORY_MAX_SESSIONS", "256"))
+
+# Daily candles for the technical indicators, kept in memory-mapped column files under this directory (see candles.py)
+CANDLES_PATH = os.getenv("CANDLES_PATH", os.path.join(".falcon_cache", "candles"))
+# Calendar days of history fetched for a new symbol; about 275 trading days covers the 200-day average
+CANDLES_LOOKBACK_DAYS = int(os.getenv("CANDLES_LOOKBACK_DAYS", "400"))
+# How often each symbol's new candles are fetched from Finnhub
+CANDLES_REFRESH_SECONDS = float(os.getenv("CANDLES_REFRESH_SECONDS", "3600"))
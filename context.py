@@ -0,0 +1,100 @@
+#Bounded context of the completed steps for the replanner
+
+import re
+import threading
+from typing import Dict, List, Tuple
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token), good enough to compare prompt sizes."""
+    return len(text) // 4
+
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+def truncate(text: str, max_chars: int) -> str:
+    """Shortens text to at most `max_chars`, preferring to cut at the end of a sentence."""
+    text = " ".join(text.split())
+    if len(text) <= max_chars:
+        return text
+    head = text[:max_chars]
+    cut = max((m.start() for m in _SENTENCE_END.finditer(head)), default=-1)
+    if cut < max_chars // 2:
+        cut = head.rfind(" ")
+    return (head[:cut] if cut > 0 else head).rstrip() + " [...]"
+
+
+def render_step(step_id: int, task: str, output: str) -> str:
+    # The id lets new steps name the results they need in `depends_on`.
+    return f"- [{step_id}] {task}\n  Result: {output}"
+
+
+class ContextCompactor:
+    """Renders the completed steps within a token budget.
+
+    Every step is sent once. The latest `keep_recent` results are kept verbatim; older ones are
+    shortened to `older_step_chars`. Shortened results are remembered per step, so each result is
+    compacted once however many times the replanner runs. If the context is still over budget, the
+    older results are shortened further, down to the task alone, and then the recent ones.
+    """
+
+    def __init__(self, budget_tokens: int = 2000, keep_recent: int = 2, older_step_chars: int = 400):
+        self.budget_tokens = budget_tokens
+        self.keep_recent = keep_recent
+        self.older_step_chars = older_step_chars
+        self._compacted: Dict[Tuple[str, str, int], str] = {}
+        self._lock = threading.Lock()
+        self._totals = {"turns": 0, "raw_tokens": 0, "tokens": 0}
+
+    def _shorten(self, task: str, output: str, max_chars: int) -> str:
+        key = (task, output, max_chars)
+        with self._lock:
+            if key not in self._compacted:
+                if len(self._compacted) > 4096:
+                    self._compacted.clear()
+                self._compacted[key] = truncate(output, max_chars) if max_chars else "(omitted to fit the context budget)"
+            return self._compacted[key]
+
+    def build(self, past_steps: List[Tuple[int, str, str]]) -> Tuple[str, dict]:
+        """Returns the context text for `(step id, task, result)` entries and how much smaller it is than sending every result verbatim."""
+        raw = "\n".join(render_step(step_id, task, output) for step_id, task, output in past_steps)
+        split = max(len(past_steps) - self.keep_recent, 0)
+        older, recent = past_steps[:split], past_steps[split:]
+        older_chars = self.older_step_chars
+        recent_chars = None
+
+        while True:
+            lines = [render_step(step_id, task, self._shorten(task, output, older_chars)) for step_id, task, output in older]
+            older_text_chars = sum(len(line) + 1 for line in lines)
+            lines += [
+                render_step(step_id, task, output if recent_chars is None else truncate(output, recent_chars))
+                for step_id, task, output in recent
+            ]
+            text = "\n".join(lines)
+            if estimate_tokens(text) <= self.budget_tokens:
+                break
+            if older and older_chars > 0:
+                older_chars = older_chars // 2 if older_chars > 50 else 0
+            elif recent and (recent_chars is None or recent_chars > 100):
+                # Share what is left of the budget between the recent results.
+                if recent_chars is None:
+                    left = self.budget_tokens * 4 - older_text_chars - sum(len(render_step(step_id, task, "")) + 1 for step_id, task, _ in recent)
+                    recent_chars = max(left // len(recent) - len(" [...]"), 200)
+                else:
+                    recent_chars //= 2
+            else:
+                break
+
+        stats = {"steps": len(past_steps), "raw_tokens": estimate_tokens(raw), "tokens": estimate_tokens(text)}
+        stats["saved_pct"] = 100 * (1 - stats["tokens"] / stats["raw_tokens"]) if stats["raw_tokens"] else 0.0
+        with self._lock:
+            self._totals["turns"] += 1
+            self._totals["raw_tokens"] += stats["raw_tokens"]
+            self._totals["tokens"] += stats["tokens"]
+        return text, stats
+
+    def stats(self) -> dict:
+        """Totals over every replanner turn so far."""
+        with self._lock:
+            return dict(self._totals)
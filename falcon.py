@@ -1,14 +1,28 @@
+import asyncio
+import hashlib
 import chainlit as cl
+import checkpoints
+import clients
+import scheduler
+import tool_memory
+import tracing
 import operator
-from langchain_google_vertexai import ChatVertexAI
-from typing import Annotated, List, Tuple, Optional
+from typing import Annotated, Dict, List, Tuple, Optional
 from typing_extensions import TypedDict
 from pydantic import BaseModel, Field
 from langgraph.prebuilt import create_react_agent
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.callbacks.manager import adispatch_custom_event
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import merge_configs
+from langchain_core.utils.json import parse_partial_json
 from langgraph.graph import END, StateGraph, START
-from tools import portfolio_retriever, stock_analyser, normal_responder, price_checker
-from config import LLM_MODEL
+from tools import portfolio_retriever, stock_analyser, normal_responder, price_checker, pnl_calculator, technical_analyser
+from context import ContextCompactor, truncate
+from plan_cache import PlanCache
+from config import LLM_MODEL, MAX_PARALLEL_STEPS, REPLAN_MODE, WARM_UP_CLIENTS
+from config import PLAN_CACHE, PLAN_CACHE_PATH, PLAN_CACHE_SIZE, SESSION_HISTORY_TURNS
+from config import REPLAN_CONTEXT_TOKENS, REPLAN_KEEP_RECENT_STEPS, REPLAN_OLDER_STEP_CHARS
 
 
 # --- Configuration and Constants ---
@@ -19,21 +33,44 @@ The user is a day trader, risk tolerance is high. time horizon for trading is us
 
 
 # --- LLM and Tools ---
-llm = ChatVertexAI(model_name=LLM_MODEL, temperature=0)
-tools = [portfolio_retriever, stock_analyser, normal_responder, price_checker]
-agent_executor = create_react_agent(llm, tools, state_modifier=AGENT_PROMPT)
+# The model and everything built on it are created on first use (see clients.py), so importing
+# this module needs no credentials and workers start quickly.
+tools = [portfolio_retriever, stock_analyser, normal_responder, price_checker, pnl_calculator, technical_analyser]
+clients.register("agent_executor", lambda: create_react_agent(clients.get("chat_llm"), tools, state_modifier=AGENT_PROMPT))
 
 # --- Data Models ---
+class Step(BaseModel):
+    """A single step of the plan."""
+    id: int = Field(description="Unique number of the step, starting from 1.")
+    task: str = Field(description="Task to perform in this step.")
+    depends_on: List[int] = Field(
+        default_factory=list,
+        description="Numbers of the steps whose results this step needs. Leave empty if the step does not need any other step.",
+    )
+
 class Plan(BaseModel):
     """Plan to follow."""
-    steps: List[str] = Field(description="Steps to follow, in order.")
+    steps: List[Step] = Field(description="Steps to follow. Steps that do not depend on each other are executed in parallel.")
+
+def add_steps(past_steps: List[Tuple[int, str, str]], new_steps: Optional[List[Tuple[int, str, str]]]) -> List[Tuple[int, str, str]]:
+    """Appends the steps of a wave; None starts a new turn without any."""
+    return [] if new_steps is None else operator.add(past_steps or [], new_steps)
+
+def add_turn(history: List[Tuple[str, str]], turns: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """Appends a finished turn, keeping the latest SESSION_HISTORY_TURNS."""
+    history = (history or []) + turns
+    return history[-SESSION_HISTORY_TURNS:] if SESSION_HISTORY_TURNS > 0 else []
 
 class PlanExecute(TypedDict):
     input: str
-    plan: List[str]
-    past_steps: Annotated[List[Tuple[str, str]], operator.add]
+    plan: List[Step]
+    # (step id, task, result) of the steps completed this turn.
+    past_steps: Annotated[List[Tuple[int, str, str]], add_steps]
+    step_results: Dict[int, str]
+    wave_ok: bool
     response: Optional[str]
-    intermediate_responses: List[str]
+    # (question, answer) of the earlier turns of the chat session, kept by the checkpointer.
+    history: Annotated[List[Tuple[str, str]], add_turn]
 
 class Response(BaseModel):
     """Response to user."""
@@ -52,20 +89,22 @@ PLANNER_PROMPT = ChatPromptTemplate.from_messages(
             "system",
             """You are an expert in deciphering questions and creating step-by-step plans.
 Based on the given objective, create a simple plan. Each step should be a distinct task that, when executed, will lead to the correct answer. Avoid superfluous steps.
+Steps that do not need each other's results (e.g. checking the prices of different stocks, retrieving the portfolio) must not depend on each other so they can run at the same time. List in `depends_on` only the steps whose results are really needed.
 Use these guidelines to choose the right tool:
 - Portfolio retrieval (e.g., "What's my portfolio?", "What are my holdings?", "Last trade on Nvidia?"): Use the {{portfolio_retriever}} tool.
 - Check the current price of a stock using the stock symbol(e.g. current price of GOOG): Use the {{price_checker}} tool. If there are multiple stocks to check, break down into multiple steps to do multiple function calls to check current price for individual stock.
+- Profit or loss, market value, weights or currency exposure of holdings (e.g., "Am I making a profit?", "How much would I make selling TSLA today?"): Use the {{pnl_calculator}} tool. It fetches the holdings and current prices itself, so it does not depend on other steps. Never calculate profit or loss yourself.
+- Trend, momentum and risk from price history (e.g., "Is NVDA trending up?", "Is Tesla overbought?", "How volatile are my stocks?", "What's Apple's drawdown?"): Use the {{technical_analyser}} tool. It handles several stocks in one step.
 - Equity/market analysis (e.g., "Will Nvidia rise?", "Current stock price?", "Is Intel a buy?", "What are the risks?"): Use the {{stock_analyser}} tool.
 - General/non-financial questions (e.g., "Hi", "Who are you?"): Use the {{normal_responder}} tool.
 The final step's result should be the final answer. Ensure each step has enough information; do not skip steps.
+Earlier questions and answers of the conversation, if any, come before the question. Use them to understand follow-up questions (e.g. "And what about Tesla?"), and name the stocks explicitly in every step.
 
 Example Qns: Should I sell off my Nvidia stocks now?
 Example Plan:
-    Step 1: Check the number of Nvidia stocks and average purchase price in portfolio using {{portfolio_retriever}} tool
-    Step 2: Check the current price of Nvidia stock using {{price_checker}} tool
-    Step 3: Analyse how Nvidia stock is doing in today's market and is it recommended to sell or hold using the {{stock_analyser}} tool
-    Step 4: Based on current price of Nvidia stock and purchase price, calculate much will user lose or profit if selling today? 
-    Step 5: Combine all pieces of information from prior steps to put up a recommendation
+    Step 1 (depends on: none): Calculate how much the user will lose or profit on the Nvidia position if selling today using {{pnl_calculator}} tool
+    Step 2 (depends on: none): Analyse how Nvidia stock is doing in today's market and is it recommended to sell or hold using the {{stock_analyser}} tool
+    Step 3 (depends on: 1, 2): Combine all pieces of information from prior steps to put up a recommendation
 """,
         ),
         ("placeholder", "{messages}"),
@@ -85,65 +124,137 @@ Your original plan:
 Completed steps:
 {past_steps}
 
-Update the plan. Include only the steps that still NEED to be done, incorporating data from previous steps. Do NOT include previously completed steps."""
+Update the plan. Include only the steps that still NEED to be done, incorporating data from previous steps. Do NOT include previously completed steps.
+Number new steps after the completed ones and keep steps that do not need each other's results independent so they can run in parallel.
+A new step that needs the result of a completed step lists that step's number, shown in brackets, in `depends_on`."""
 )
 
 # --- Chains and Agents ---
-planner = PLANNER_PROMPT | llm.with_structured_output(Plan)
-replanner = REPLANNER_PROMPT | llm.with_structured_output(Act)
+clients.register("planner", lambda: PLANNER_PROMPT | clients.get("chat_llm").with_structured_output(Plan))
+clients.register("replanner", lambda: REPLANNER_PROMPT | clients.get("chat_llm").with_structured_output(Act))
 
 # --- Mis ---
 def clean_newlines(text: str) -> str:
     """Removes extra newline characters from a string."""
     return text.replace("\n\n", "\n")
 
+def format_plan(plan: List[Step]) -> str:
+    """Renders the plan with the dependencies of each step."""
+    lines = []
+    for step in plan:
+        after = f" (after step {', '.join(str(d) for d in step.depends_on)})" if step.depends_on else ""
+        lines.append(f"{step.id}. {step.task}{after}")
+    return "\n".join(lines)
+
+def ready_steps(plan: List[Step]) -> List[Step]:
+    """Returns the steps whose dependencies are no longer pending in the plan."""
+    pending = {step.id for step in plan}
+    ready = [step for step in plan if not pending.intersection(set(step.depends_on) - {step.id})]
+    # A cyclic plan has no ready step; fall back to running the steps in order.
+    return ready or plan[:1]
+
 # --- Workflow Nodes ---
-async def plan_step(state: PlanExecute):
-    plan = await planner.ainvoke({"messages": [("user", state["input"])]})
-    with cl.Step(name="Generated Plan"):
-        await cl.Message(content="**Generated Plan:**").send()
-        for i, step in enumerate(plan.steps):
-            await cl.Message(content=f" {step}").send()
-    return {"plan": plan.steps, "intermediate_responses": []}
-
-async def execute_step(state: PlanExecute):
+# The nodes report progress through custom events instead of talking to Chainlit directly;
+# `stream_workflow` turns them, and the model tokens, into UI updates.
+STEP_TAG = "falcon_step:"
+context_compactor = ContextCompactor(REPLAN_CONTEXT_TOKENS, REPLAN_KEEP_RECENT_STEPS, REPLAN_OLDER_STEP_CHARS)
+# Cached plans are only valid for the planner that made them.
+plan_cache = PlanCache(PLAN_CACHE_SIZE, PLAN_CACHE_PATH, version=hashlib.sha1(f"{LLM_MODEL}\n{PLANNER_PROMPT.messages[0].prompt.template}".encode()).hexdigest())
+
+@tracing.traced("node")
+@scheduler.prioritised(scheduler.INTERACTIVE)
+async def plan_step(state: PlanExecute, config: RunnableConfig):
+    history = state.get("history") or []
+    # A follow-up is planned in the light of the earlier turns, so only first questions share plans.
+    use_cache = PLAN_CACHE and not history
+    cached = plan_cache.get(state["input"]) if use_cache else None
+    if cached:
+        steps = [Step(**step) for step in cached]
+        print(f"Plan cache hit ({plan_cache.stats()['hit_rate']:.0%} hit rate)")
+        tracing.event("cache", "plan_cache_hit")
+    else:
+        messages = []
+        for question, answer in history:
+            messages += [("user", question), ("assistant", truncate(answer, 1000))]
+        messages.append(("user", state["input"]))
+        steps = (await clients.get("planner").ainvoke({"messages": messages}, config)).steps
+        if use_cache:
+            plan_cache.put(state["input"], [step.model_dump() for step in steps])
+    await adispatch_custom_event("plan", {"plan": format_plan(steps)}, config=config)
+    return {"plan": steps, "step_results": {}}
+
+@tracing.traced("node")
+async def execute_step(state: PlanExecute, config: RunnableConfig):
     plan = state["plan"]
     if not plan:
         return {"response": "No more steps in the plan."}
 
-    plan_str = "\n".join(f"{i+1}. {step}" for i, step in enumerate(plan))
-    task = plan[0]
-    step_number = len(state.get("past_steps", [])) + 1
-    task_formatted = f"""For the following plan: {plan_str}\n\nYou are tasked with executing step {step_number}, {task}."""
+    plan_str = format_plan(plan)
+    step_results = state.get("step_results") or {}
+    batch = ready_steps(plan)
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_STEPS)
+
+    async def run(step: Step) -> str:
+        inputs = "\n".join(
+            f"Result of step {d}: {step_results[d]}" for d in step.depends_on if d in step_results
+        )
+        task_formatted = f"""For the following plan: {plan_str}\n\nYou are tasked with executing step {step.id}, {step.task}."""
+        if inputs:
+            task_formatted += f"\n\nResults of the steps it depends on:\n{inputs}"
 
-    with cl.Step(name=f"Executing: {task}"):
-        await cl.Message(content=f"**Executing** {task}").send()
-        agent_response = await agent_executor.ainvoke({"messages": [("user", task_formatted)]})
-        final_response = agent_response["messages"][-1].content
+        # The tag lets the UI route the tokens of concurrently running steps to the right message.
+        step_config = merge_configs(config, {"tags": [f"{STEP_TAG}{step.id}"]})
+        async with semaphore:
+            await adispatch_custom_event("step_start", {"id": step.id, "task": step.task}, config=step_config)
+            with tracing.span("step", "agent_step", step_id=step.id) as span:
+                try:
+                    agent_response = await clients.get("agent_executor").ainvoke({"messages": [("user", task_formatted)]}, step_config)
+                    final_response = agent_response["messages"][-1].content
+                except Exception as e:
+                    # Let the replanner deal with a failed step instead of aborting its siblings.
+                    final_response = f"Step failed: {e}"
+                    span.set(error=str(e))
+            await adispatch_custom_event("step_end", {"id": step.id, "task": step.task, "output": final_response}, config=step_config)
+        return final_response
 
-        await cl.Message(content=final_response).send()
+    responses = await asyncio.gather(*(run(step) for step in batch))
+    done = {step.id for step in batch}
+    failed = [step.id for step, response in zip(batch, responses) if not response.strip() or response.startswith("Step failed:")]
 
     return {
-        "past_steps": state.get("past_steps", []) + [(task, final_response)],
-        "plan": plan[1:],
-        "intermediate_responses": state.get("intermediate_responses", []) + [final_response]
+        # past_steps is appended to by its reducer, so only the new entries are returned.
+        "past_steps": [(step.id, step.task, response) for step, response in zip(batch, responses)],
+        "plan": [step for step in plan if step.id not in done],
+        "step_results": {**step_results, **{step.id: response for step, response in zip(batch, responses)}},
+        "wave_ok": not failed,
     }
 
-async def replan_step(state: PlanExecute):
-    all_responses = "\n".join(state["intermediate_responses"])
-    all_steps = "\n".join([f"{step}: {response}" for step, response in state["past_steps"]])
-    context = f"Here is the information gathered from the previous steps:\n{all_steps}\n\nHere are the direct responses from the tools:\n{all_responses}"
+@tracing.traced("node")
+@scheduler.prioritised(scheduler.INTERACTIVE)
+async def replan_step(state: PlanExecute, config: RunnableConfig):
+    # Each step result is sent once, within a token budget, instead of the full history twice over.
+    with tracing.span("context", "replan_context") as span:
+        context, stats = context_compactor.build(state["past_steps"])
+        span.set(**stats)
+    print(f"Replanner context: ~{stats['tokens']} tokens for {stats['steps']} steps (~{stats['raw_tokens']} verbatim, {stats['saved_pct']:.0f}% saved)")
 
-    output = await replanner.ainvoke({**state, "input": context})
+    output = await clients.get("replanner").ainvoke(
+        {"input": state["input"], "plan": format_plan(state["plan"]), "past_steps": context}, config
+    )
     if output.response:
         cleaned_response = clean_newlines(output.response.response)
-        with cl.Step(name="Final Response"):
-            await cl.Message(content="**Final Response:**").send()
-            await cl.Message(content=cleaned_response).send()
-        return {"response": cleaned_response}
+        await adispatch_custom_event("final", {"response": cleaned_response}, config=config)
+        return {"response": cleaned_response, "history": [(state["input"], cleaned_response)]}
     else:
         return {"plan": output.plan.steps}
 
+def should_replan(state: PlanExecute):
+    """After a wave of steps: replan, or in on_demand mode carry on with the plan while it goes well."""
+    if REPLAN_MODE == "on_demand" and state.get("wave_ok") and state["plan"]:
+        tracing.event("route", "replan_skipped", remaining_steps=len(state["plan"]))
+        return "agent"
+    return "replan"
+
 def should_end(state: PlanExecute):
     return END if "response" in state and state["response"] is not None else "agent"
 
@@ -154,29 +265,115 @@ workflow.add_node("agent", execute_step)
 workflow.add_node("replan", replan_step)
 workflow.add_edge(START, "planner")
 workflow.add_edge("planner", "agent")
-workflow.add_edge("agent", "replan")
+workflow.add_conditional_edges("agent", should_replan, {"agent": "agent", "replan": "replan"})
 workflow.add_conditional_edges("replan", should_end, {"agent": "agent", END: END})
 app = workflow.compile()
+_session_app = None
+
+async def session_app():
+    """The workflow with its state checkpointed per chat session (`thread_id`); `app` without a checkpointer."""
+    global _session_app
+    if _session_app is None:
+        saver = await checkpoints.get_saver()
+        _session_app = workflow.compile(checkpointer=saver) if saver is not None else app
+    return _session_app
+
+if WARM_UP_CLIENTS:
+    clients.warm_up()
+
+# --- Streaming ---
+def _chunk_text(chunk) -> str:
+    """Text of a streamed message chunk; Gemini may send the content as a list of parts."""
+    if isinstance(chunk.content, str):
+        return chunk.content
+    return "".join(part if isinstance(part, str) else part.get("text", "") for part in chunk.content)
+
+async def stream_workflow(inputs: dict, config: dict):
+    """Runs the workflow and yields `(kind, data)` UI updates as they happen.
+
+    Kinds are `plan`, `step_start`, `step_token`, `step_end`, `final_token` and `final`. The final
+    answer is streamed out of the replanner's structured output while its arguments are still
+    being generated. Works with any chat model that supports streaming, fakes included. With a
+    `thread_id` in the config the run continues the state of that chat session.
+    """
+    replan_args: Dict[str, str] = {}
+    replan_sent: Dict[str, int] = {}
+    graph = await session_app() if config.get("configurable", {}).get("thread_id") else app
+    async for event in graph.astream_events(inputs, config=config, version="v2"):
+        kind = event["event"]
+        if kind == "on_custom_event" and event["name"] in ("plan", "step_start", "step_end", "final"):
+            yield event["name"], event["data"]
+        elif kind == "on_chat_model_stream":
+            node = event["metadata"].get("langgraph_node")
+            chunk = event["data"]["chunk"]
+            if node == "agent":
+                # Only the agent's own model calls; models used inside tools run in the "tools" node.
+                step_ids = [tag[len(STEP_TAG):] for tag in event.get("tags", []) if tag.startswith(STEP_TAG)]
+                text = _chunk_text(chunk)
+                if step_ids and text:
+                    yield "step_token", {"id": int(step_ids[-1]), "token": text}
+            elif node == "replan":
+                run_id = event["run_id"]
+                replan_args[run_id] = replan_args.get(run_id, "") + "".join(
+                    tool_chunk.get("args") or "" for tool_chunk in getattr(chunk, "tool_call_chunks", [])
+                )
+                parsed = parse_partial_json(replan_args[run_id]) if replan_args[run_id] else None
+                response = parsed.get("response") if isinstance(parsed, dict) else None
+                text = response.get("response") if isinstance(response, dict) else None
+                if isinstance(text, str) and len(text) > replan_sent.get(run_id, 0):
+                    yield "final_token", {"token": text[replan_sent.get(run_id, 0):]}
+                    replan_sent[run_id] = len(text)
 
 # --- Chainlit Interface ---
 @cl.on_chat_start
 async def start():
     await cl.Message(content="Hello! How can I help you today?").send()
 
+@cl.on_app_shutdown
+async def shutdown():
+    await checkpoints.close()
+
 @cl.on_message
 async def main(message: cl.Message):
     
-    config = {"recursion_limit": 50}
-    async for event in app.astream(
-        {"input": message.content, "plan": [], "past_steps": [], "response": None, "intermediate_responses": []},
-        config=config,
-    ):
-        if "response" in event:
-            # Final response is handled in replan_step, no action needed here
-            pass
-        elif "plan" in event:
-            # Plan generation messages are handled in plan_step, no action needed here
-            pass
-        elif "past_steps" in event:
-            # Execution step messages are handled in execute_step, no action needed here
-            pass
\ No newline at end of file
+    thread_id = cl.context.session.thread_id
+    config = {"recursion_limit": 50, "callbacks": tracing.callbacks(), "configurable": {"thread_id": thread_id}}
+    steps = {}  # step id -> (cl.Step, streaming cl.Message)
+    final_message = None
+
+    async def start_final():
+        await cl.Message(content="**Final Response:**").send()
+        return cl.Message(content="")
+
+    # One trace per chat turn: every node, tool and upstream span below nests under it. The
+    # session's earlier turns come from the checkpointer; the per-turn fields start afresh.
+    with tracing.span("request", "chat_turn"), tool_memory.session(thread_id):
+        async for kind, data in stream_workflow(
+            {"input": message.content, "plan": [], "past_steps": None, "step_results": {}, "wave_ok": True, "response": None},
+            config,
+        ):
+            if kind == "plan":
+                async with cl.Step(name="Generated Plan"):
+                    await cl.Message(content="**Generated Plan:**").send()
+                    await cl.Message(content=data["plan"]).send()
+            elif kind == "step_start":
+                cl_step = cl.Step(name=f"Executing: {data['task']}")
+                await cl_step.send()
+                await cl.Message(content=f"**Executing** {data['task']}", parent_id=cl_step.id).send()
+                steps[data["id"]] = (cl_step, cl.Message(content="", parent_id=cl_step.id))
+            elif kind == "step_token":
+                await steps[data["id"]][1].stream_token(data["token"])
+            elif kind == "step_end":
+                cl_step, step_message = steps.pop(data["id"])
+                # Replace whatever was streamed (e.g. text before a tool call) with the step's answer.
+                step_message.content = data["output"]
+                await step_message.send()
+                await cl_step.update()
+            elif kind == "final_token":
+                final_message = final_message or await start_final()
+                await final_message.stream_token(data["token"])
+            elif kind == "final":
+                final_message = final_message or await start_final()
+                final_message.content = data["response"]
+                await final_message.send()
+    await checkpoints.prune(thread_id)
@@ -1,30 +1,81 @@
-from google.cloud import discoveryengine_v1 as discoveryengine
-from vertexai.generative_models import GenerativeModel
 from config import PROJECT_NUMBER, SEARCH_ENGINE_ID
-from typing import List
+from config import GROUNDING_CACHE_BUCKET_SECONDS, GROUNDING_CACHE_SIZE, GROUNDING_REWRITE
+from cache import TTLCache
+from context import estimate_tokens
+from symbols import normalize_question
+from typing import List, Tuple
+import clients
+import scheduler
+import tracing
 import json
+import threading
+import time
 
-#variables
-spec = discoveryengine.GenerateGroundedContentRequest.GenerationSpec(
-        model_id="gemini-1.5-flash",
-        temperature=0.0,
-        top_p=1,
-        top_k=1,
-)
-
-#client initialisation
-google_search_client = discoveryengine.GroundedGenerationServiceClient()
-model = GenerativeModel(
-    "gemini-1.5-pro",
-    system_instruction=f"""You are Falcon, one of the most seasoned equity traders in the world.
-        Your goal is to help to answer the user question with comprehensive analysis based on what you have been trained on, or knowledge from Google Search or knowledge from internal proprietary investment research.
-        You need to return a response that explains how you came up with that answer, backed by evidence that you used in coming up with the answer.
-        The user is a day trader, risk tolerance is high. time horizon for trading is usually 1-2 months. Investment goal is to maximise the opportunity cost of the funds and reap maximum returns within the time horizon.
-        """
-)
+#client initialisation, deferred to first use (see clients.py)
+def _search_client():
+    from google.cloud import discoveryengine_v1 as discoveryengine
+    return discoveryengine.GroundedGenerationServiceClient()
 
+def _analysis_model():
+    from vertexai.generative_models import GenerativeModel
+    return GenerativeModel(
+        "gemini-1.5-pro",
+        system_instruction=f"""You are Falcon, one of the most seasoned equity traders in the world.
+            Your goal is to help to answer the user question with comprehensive analysis based on what you have been trained on, or knowledge from Google Search or knowledge from internal proprietary investment research.
+            You need to return a response that explains how you came up with that answer, backed by evidence that you used in coming up with the answer.
+            The user is a day trader, risk tolerance is high. time horizon for trading is usually 1-2 months. Investment goal is to maximise the opportunity cost of the funds and reap maximum returns within the time horizon.
+            """
+    )
 
-def google_ground(prompt: str) -> str:
+clients.register("grounding_search", _search_client)
+clients.register("grounding_model", _analysis_model)
+
+
+#Grounded analyses are shared by every session asking the same question within the same time bucket
+grounding_cache = TTLCache(maxsize=GROUNDING_CACHE_SIZE, ttl=GROUNDING_CACHE_BUCKET_SECONDS)
+_savings = {"cache_seconds_saved": 0.0, "cache_input_tokens_saved": 0, "rewrite_input_tokens_saved": 0}
+_savings_lock = threading.Lock()
+
+
+def extract_grounded(google_responses) -> Tuple[str, List[str]]:
+    """Returns the answer text and the cited sources of a grounded generation response."""
+    if not google_responses.candidates:
+        return "", []
+    candidate = google_responses.candidates[0]
+    text = "".join(part.text for part in candidate.content.parts if part.text)
+    citations = []
+    for chunk in candidate.grounding_metadata.support_chunks:
+        metadata = dict(chunk.source_metadata)
+        citation = " - ".join(v for v in (metadata.get("title"), metadata.get("uri")) if v)
+        if citation and citation not in citations:
+            citations.append(citation)
+    return text, citations
+
+
+def _record(**saved):
+    with _savings_lock:
+        for name, value in saved.items():
+            _savings[name] += value
+
+
+def grounding_stats() -> dict:
+    """Cache counters plus the time and (estimated) input tokens saved so far."""
+    with _savings_lock:
+        return {**grounding_cache.stats(), **_savings}
+
+
+def _ground(prompt: str) -> dict:
+    from google.cloud import discoveryengine_v1 as discoveryengine
+
+    start = time.monotonic()
+    google_search_client = clients.get("grounding_search")
+    #variables
+    spec = discoveryengine.GenerateGroundedContentRequest.GenerationSpec(
+            model_id="gemini-1.5-flash",
+            temperature=0.0,
+            top_p=1,
+            top_k=1,
+    )
     request = discoveryengine.GenerateGroundedContentRequest(
         location=google_search_client.common_location_path(
                 project=PROJECT_NUMBER, location="global"
@@ -49,11 +100,44 @@ def google_ground(prompt: str) -> str:
             ]
         ),
     )
-    google_responses = google_search_client.generate_grounded_content(request)
-    
+    with scheduler.slot("discoveryengine"), tracing.span("upstream", "discoveryengine.grounded_generation", estimated_input_tokens=estimate_tokens(prompt)):
+        google_responses = google_search_client.generate_grounded_content(request)
+    input_tokens = estimate_tokens(prompt)
+
     print(google_responses)  # Print the extracted text
-    return_prompt=f"""Generate a natural language response based on the original question: '{prompt}' and the returned results: '{google_responses}'"""
+    text, citations = extract_grounded(google_responses)
+    sources = "\n".join(f"- {citation}" for citation in citations)
+    if GROUNDING_REWRITE == "none":
+        answer = f"{text}\n\nSources:\n{sources}" if sources else text
+        _record(rewrite_input_tokens_saved=estimate_tokens(str(google_responses)))
+    else:
+        results = str(google_responses)
+        if GROUNDING_REWRITE == "text":
+            results = f"{text}\n\nSources:\n{sources}"
+            _record(rewrite_input_tokens_saved=max(estimate_tokens(str(google_responses)) - estimate_tokens(results), 0))
+        return_prompt=f"""Generate a natural language response based on the original question: '{prompt}' and the returned results: '{results}'"""
+
+        with scheduler.slot("vertexai"), tracing.span("upstream", "vertexai.grounding_rewrite", rewrite=GROUNDING_REWRITE) as span:
+            response=clients.get("grounding_model").generate_content(return_prompt)
+            tracing.record_usage(span, response)
+        answer = response.text
+        input_tokens += estimate_tokens(return_prompt)
+
+    return {"answer": answer, "seconds": time.monotonic() - start, "input_tokens": input_tokens}
+
+
+def google_ground(prompt: str) -> str:
+    key = (normalize_question(prompt), int(time.time() // GROUNDING_CACHE_BUCKET_SECONDS))
+    computed = []
 
-    response=model.generate_content(return_prompt)
-    return response.text
+    def load(keys):
+        computed.append(True)
+        return {key: _ground(prompt)}
 
+    result = grounding_cache.get_many([key], load)[key]
+    if isinstance(result, Exception):
+        raise result
+    if not computed:
+        print(f"Grounding cache hit, saved {result['seconds']:.1f}s and ~{result['input_tokens']} input tokens")
+        _record(cache_seconds_saved=result["seconds"], cache_input_tokens_saved=result["input_tokens"])
+    return result["answer"]
@@ -0,0 +1,157 @@
+#Local columnar copy of the holdings table, refreshed incrementally from BigQuery
+
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+import scheduler
+import tracing
+
+
+COLUMNS = ("symbol", "company_name", "quantity", "purchase_price", "purchase_date", "currency")
+_DTYPES = {
+    "symbol": str,
+    "company_name": str,
+    "quantity": np.int64,
+    "purchase_price": np.float64,
+    "purchase_date": "datetime64[D]",
+    "currency": str,
+}
+
+
+def to_columns(rows: Iterable) -> Dict[str, np.ndarray]:
+    rows = [dict(row) for row in rows]
+    return {
+        column: np.array([row.get(column) for row in rows], dtype=_DTYPES[column]) if rows
+        else np.array([], dtype=_DTYPES[column])
+        for column in COLUMNS
+    }
+
+
+class HoldingsSnapshot:
+    """Holdings table kept in memory as one NumPy array per column.
+
+    The first load reads the whole table. Later refreshes only fetch the rows on or after the
+    latest `purchase_date` seen (the watermark) and replace the local rows of that day, so lots
+    added later in the same day are not missed. A periodic full reload picks up sold or edited
+    lots, which the watermark cannot see. `client` is anything with the `bigquery.Client.query`
+    interface, so a local fake works for tests.
+    """
+
+    def __init__(self, client, table: str, refresh_seconds: float = 300, full_refresh_seconds: float = 3600,
+                 clock=time.monotonic):
+        self.client = client
+        self.table = table
+        self.refresh_seconds = refresh_seconds
+        self.full_refresh_seconds = full_refresh_seconds
+        self.clock = clock
+        self.columns: Optional[Dict[str, np.ndarray]] = None
+        self.watermark: Optional[np.datetime64] = None
+        self.refreshed_at = 0.0
+        self.full_loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _query(self, sql: str, query_parameters=()) -> Dict[str, np.ndarray]:
+        from google.cloud import bigquery
+
+        job_config = bigquery.QueryJobConfig(maximum_bytes_billed=100000000, query_parameters=list(query_parameters))
+        with scheduler.slot("bigquery"), tracing.span("upstream", "bigquery.query", template="snapshot") as span:
+            columns = to_columns(self.client.query(sql, job_config=job_config).result())
+            span.set(rows=len(columns["symbol"]))
+        return columns
+
+    def _set(self, columns: Dict[str, np.ndarray]):
+        dates = columns["purchase_date"]
+        self.watermark = dates.max() if len(dates) else None
+        # Swap the whole dict at once so readers never see columns of different lengths.
+        self.columns = columns
+        self.refreshed_at = self.clock()
+
+    def load(self):
+        """Reloads the whole table."""
+        with self._lock:
+            self._set(self._query(f"SELECT {', '.join(COLUMNS)} FROM {self.table}"))
+            self.full_loaded_at = self.refreshed_at
+
+    def refresh(self):
+        """Fetches the rows at or after the watermark, or reloads everything when it is time to."""
+        if self.columns is None or self.watermark is None or self.clock() - self.full_loaded_at >= self.full_refresh_seconds:
+            return self.load()
+        from google.cloud import bigquery
+
+        with self._lock:
+            watermark = self.watermark
+            fresh = self._query(
+                f"SELECT {', '.join(COLUMNS)} FROM {self.table} WHERE purchase_date >= @watermark",
+                [bigquery.ScalarQueryParameter("watermark", "DATE", watermark.item())],
+            )
+            keep = self.columns["purchase_date"] < watermark
+            self._set({column: np.concatenate([self.columns[column][keep], fresh[column]]) for column in COLUMNS})
+
+    def ensure_fresh(self) -> Dict[str, np.ndarray]:
+        """Returns the columns, refreshing them first if they are older than `refresh_seconds`."""
+        if self.columns is None or self.clock() - self.refreshed_at >= self.refresh_seconds:
+            self.refresh()
+        return self.columns
+
+    def start(self):
+        """Refreshes the snapshot every `refresh_seconds` on a background thread."""
+        def run():
+            while not self._stop.wait(self.refresh_seconds):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Holdings snapshot refresh failed: {e}")
+
+        self.ensure_fresh()
+        threading.Thread(target=run, name="holdings-snapshot", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def select(self, symbols: Optional[Iterable[str]] = None) -> Dict[str, np.ndarray]:
+        """Returns the columns, restricted to the given symbols if any."""
+        columns = self.ensure_fresh()
+        if not symbols:
+            return columns
+        mask = np.isin(columns["symbol"], list(symbols))
+        return {column: values[mask] for column, values in columns.items()}
+
+    def rows(self, symbols: Optional[Iterable[str]] = None) -> List[dict]:
+        """Returns the lots as dicts, like the rows of a BigQuery result."""
+        columns = self.select(symbols)
+        values = [columns[column].tolist() for column in COLUMNS]
+        return [dict(zip(COLUMNS, row)) for row in zip(*values)]
+
+    def positions(self, symbols: Optional[Iterable[str]] = None) -> List[dict]:
+        """Aggregates the lots per symbol: total quantity, average purchase price and purchase dates."""
+        columns = self.select(symbols)
+        if not len(columns["symbol"]):
+            return []
+        keys, first, inverse = np.unique(columns["symbol"], return_index=True, return_inverse=True)
+        quantity = np.bincount(inverse, weights=columns["quantity"])
+        cost = np.bincount(inverse, weights=columns["quantity"] * columns["purchase_price"])
+        avg_price = np.divide(cost, quantity, out=np.full_like(cost, np.nan), where=quantity != 0)
+        days = columns["purchase_date"].astype(np.int64)
+        first_date = np.full(len(keys), np.iinfo(np.int64).max)
+        last_date = np.full(len(keys), np.iinfo(np.int64).min)
+        np.minimum.at(first_date, inverse, days)
+        np.maximum.at(last_date, inverse, days)
+        first_date, last_date = first_date.astype("datetime64[D]"), last_date.astype("datetime64[D]")
+        lots = np.bincount(inverse)
+        return [
+            {
+                "symbol": str(keys[i]),
+                "company_name": str(columns["company_name"][first[i]]),
+                "currency": str(columns["currency"][first[i]]),
+                "quantity": int(quantity[i]),
+                "avg_purchase_price": float(avg_price[i]),
+                "first_purchase_date": first_date[i].item(),
+                "last_purchase_date": last_date[i].item(),
+                "lots": int(lots[i]),
+            }
+            for i in range(len(keys))
+        ]
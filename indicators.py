@@ -0,0 +1,128 @@
+#Vectorised technical indicators over the daily closes of many symbols at once
+
+import datetime
+from typing import Dict, List
+
+import numpy as np
+
+
+TRADING_DAYS_PER_YEAR = 252
+
+
+def _last_window(closes: np.ndarray, window: int) -> np.ndarray:
+    """The latest `window` columns; NaN rows where there is not that much history."""
+    if closes.shape[1] < window:
+        return np.full((closes.shape[0], window), np.nan)
+    return closes[:, -window:]
+
+
+def sma(closes: np.ndarray, window: int) -> np.ndarray:
+    """Latest simple moving average of each row."""
+    return _last_window(closes, window).mean(axis=1)
+
+
+def change(closes: np.ndarray, days: int) -> np.ndarray:
+    """Return over the last `days` days of each row."""
+    window = _last_window(closes, days + 1)
+    return window[:, -1] / window[:, 0] - 1
+
+
+def volatility(closes: np.ndarray, window: int = 20) -> np.ndarray:
+    """Annualised standard deviation of the daily log returns over the last `window` days."""
+    returns = np.diff(np.log(_last_window(closes, window + 1)), axis=1)
+    return returns.std(axis=1, ddof=1) * np.sqrt(TRADING_DAYS_PER_YEAR)
+
+
+def rsi(closes: np.ndarray, period: int = 14) -> np.ndarray:
+    """Wilder's relative strength index of each row.
+
+    The first `period` changes seed the averages, which are then smoothed day by day; each day is
+    one vector step over all rows. Rows with fewer than `period` changes are NaN.
+    """
+    n = closes.shape[0]
+    seen = np.zeros(n, dtype=np.int64)
+    sum_gain, sum_loss = np.zeros(n), np.zeros(n)
+    avg_gain, avg_loss = np.full(n, np.nan), np.full(n, np.nan)
+    for diff in np.diff(closes, axis=1).T:
+        valid = np.isfinite(diff)
+        seen += valid
+        gain = np.where(valid, np.maximum(diff, 0), 0.0)
+        loss = np.where(valid, np.maximum(-diff, 0), 0.0)
+        warming = valid & (seen <= period)
+        sum_gain += np.where(warming, gain, 0.0)
+        sum_loss += np.where(warming, loss, 0.0)
+        seeded = valid & (seen == period)
+        avg_gain = np.where(seeded, sum_gain / period, avg_gain)
+        avg_loss = np.where(seeded, sum_loss / period, avg_loss)
+        smoothed = valid & (seen > period)
+        avg_gain = np.where(smoothed, (avg_gain * (period - 1) + gain) / period, avg_gain)
+        avg_loss = np.where(smoothed, (avg_loss * (period - 1) + loss) / period, avg_loss)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        strength = 100 - 100 / (1 + avg_gain / avg_loss)
+    return np.where(avg_loss == 0, np.where(avg_gain > 0, 100.0, 50.0), strength)
+
+
+def drawdowns(closes: np.ndarray):
+    """Largest peak-to-trough fall of each row, and how far below its peak it is now."""
+    peak = np.fmax.accumulate(closes, axis=1)
+    fall = closes / peak - 1
+    has_data = np.isfinite(closes).any(axis=1)
+    max_drawdown = np.where(has_data, np.fmin.reduce(fall, axis=1), np.nan)
+    return max_drawdown, fall[:, -1]
+
+
+def compute_indicators(closes: np.ndarray) -> Dict[str, np.ndarray]:
+    """Every indicator for a (symbols x days) matrix of daily closes, oldest first and NaN-padded at the front."""
+    max_drawdown, drawdown = drawdowns(closes)
+    return {
+        "days": np.isfinite(closes).sum(axis=1),
+        "close": closes[:, -1],
+        "sma20": sma(closes, 20),
+        "sma50": sma(closes, 50),
+        "sma200": sma(closes, 200),
+        "rsi14": rsi(closes, 14),
+        "volatility20": volatility(closes, 20),
+        "change_1m": change(closes, 21),
+        "change_3m": change(closes, 63),
+        "max_drawdown": max_drawdown,
+        "drawdown": drawdown,
+    }
+
+
+def _trend(close: float, sma50: float, sma200: float) -> str:
+    if not np.isfinite([close, sma50, sma200]).all():
+        return "trend unknown (not enough history)"
+    if close > sma50 > sma200:
+        return "uptrend (price above the 50-day average, which is above the 200-day)"
+    if close < sma50 < sma200:
+        return "downtrend (price below the 50-day average, which is below the 200-day)"
+    return "mixed trend"
+
+
+def _num(value: float, spec: str = ".2f") -> str:
+    return format(value, spec) if np.isfinite(value) else "n/a"
+
+
+def _pct(value: float) -> str:
+    return f"{value * 100:+.1f}%" if np.isfinite(value) else "n/a"
+
+
+def format_indicators(symbols: List[str], values: Dict[str, np.ndarray], last_times: np.ndarray) -> str:
+    """Renders the indicators for the agent, one line per symbol."""
+    lines = []
+    for i, symbol in enumerate(symbols):
+        if not values["days"][i]:
+            lines.append(f"{symbol}: no price history available.")
+            continue
+        as_of = datetime.datetime.fromtimestamp(int(last_times[i]), datetime.timezone.utc).date()
+        rsi14 = values["rsi14"][i]
+        zone = " (overbought)" if rsi14 >= 70 else " (oversold)" if rsi14 <= 30 else ""
+        lines.append(
+            f"{symbol} (daily candles to {as_of}, {values['days'][i]} days): close {_num(values['close'][i])}, "
+            f"SMA20 {_num(values['sma20'][i])}, SMA50 {_num(values['sma50'][i])}, SMA200 {_num(values['sma200'][i])}, "
+            f"{_trend(values['close'][i], values['sma50'][i], values['sma200'][i])}; RSI14 {_num(rsi14, '.1f')}{zone}; "
+            f"20-day volatility {_num(values['volatility20'][i] * 100, '.1f')}% annualised; "
+            f"change 1M {_pct(values['change_1m'][i])}, 3M {_pct(values['change_3m'][i])}; "
+            f"max drawdown {_pct(values['max_drawdown'][i])}, now {_pct(values['drawdown'][i])} from the peak"
+        )
+    return "\n".join(lines)
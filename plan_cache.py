@@ -0,0 +1,173 @@
+#Plans of recurring question shapes, reused with the new question's companies filled in
+
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from symbols import SymbolMatch, get_symbol_index, normalize
+
+
+def _placeholder(i: int) -> str:
+    return f"<entity{i}>"
+
+
+def abstract_question(question: str) -> Tuple[str, List[SymbolMatch]]:
+    """Returns the shape of a question and the companies it mentions, one per placeholder.
+
+    "Should I sell my Nvidia stocks?" and "should i sell my TSLA stocks" have the same shape.
+    """
+    entities: List[SymbolMatch] = []
+    slots = {}
+    parts, last = [], 0
+    for match in get_symbol_index().find(question):
+        if match.symbol not in slots:
+            slots[match.symbol] = len(entities)
+            entities.append(match)
+        parts.append(question[last:match.start])
+        parts.append(f" entity{slots[match.symbol]} ")
+        last = match.end
+    parts.append(question[last:])
+    return normalize("".join(parts))[0], entities
+
+
+# "<entity0> (<entity0>)" or "<entity0> stock (<entity0>)", from a step that named a company and its ticker.
+_SAME_ENTITY = re.compile(r"(<entity\d+>)((?:\s+[^\s()<>]+){0,3}?)\s*\(\s*\$?\1\s*\)")
+_PLACEHOLDER = re.compile(r"<entity\d+>")
+
+
+def template_steps(steps: List[dict], entities: List[SymbolMatch]) -> Optional[List[dict]]:
+    """Replaces the mentions of the question's companies in the steps with placeholders.
+
+    "Nvidia (NVDA)" and "Nvidia stock (NVDA)" become a single placeholder. Returns None if a step
+    mentions a company that is not in the question (the planner's own choice, which would not fit
+    another question), mentions one company more than once, or mentions one in a way that cannot
+    be abstracted.
+    """
+    index = get_symbol_index()
+    slots = {entity.symbol: i for i, entity in enumerate(entities)}
+    templated = []
+    for step in steps:
+        task, parts, last = step["task"], [], 0
+        for match in index.find(task):
+            if match.symbol in slots:
+                parts.append(task[last:match.start])
+                parts.append(_placeholder(slots[match.symbol]))
+                last = match.end
+            else:
+                return None
+        parts.append(task[last:])
+        task = _SAME_ENTITY.sub(r"\1\2", "".join(parts))
+        # Filled in again, each mention would read "Apple (AAPL)".
+        placeholders = _PLACEHOLDER.findall(task)
+        if len(placeholders) != len(set(placeholders)):
+            return None
+        templated.append({**step, "task": task})
+    if any(index.find(step["task"]) for step in templated):
+        return None
+    return templated
+
+
+def fill_steps(steps: List[dict], entities: List[SymbolMatch]) -> List[dict]:
+    """Puts the new question's companies into a plan template."""
+    filled = []
+    for step in steps:
+        task = step["task"]
+        for i, entity in enumerate(entities):
+            mention = entity.symbol if entity.text.upper().lstrip("$") == entity.symbol else f"{entity.text} ({entity.symbol})"
+            task = task.replace(_placeholder(i), mention)
+        filled.append({**step, "task": task})
+    return filled
+
+
+class PlanCache:
+    """LRU map of question shapes to plan templates, optionally persisted to a JSON file.
+
+    `version` identifies the planner (model and prompt); a file written for another version is
+    ignored, so changing the prompt never serves stale plans. Templates abstracted with another
+    symbol index (listing or matching rules) are dropped on first use, since their placeholders
+    may stand for words that are no longer companies.
+    """
+
+    def __init__(self, maxsize: int = 256, path: Optional[str] = None, version: str = ""):
+        self.maxsize = maxsize
+        self.path = path
+        self.version = version
+        self._entries: "OrderedDict[str, List[dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "uncacheable": 0, "evictions": 0}
+        self._index: Optional[str] = None
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable plan cache {self.path}: {e}")
+            return
+        if data.get("version") != self.version:
+            return
+        self._index = data.get("index", "")
+        for key, steps in data.get("entries", [])[-self.maxsize:]:
+            self._entries[key] = steps
+
+    def _check_index(self, fingerprint: str):
+        if self._index is not None and self._index != fingerprint:
+            self._entries.clear()
+        self._index = fingerprint
+
+    def _save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": self.version, "index": self._index, "entries": list(self._entries.items())}, f)
+        os.replace(tmp, self.path)
+
+    def get(self, question: str) -> Optional[List[dict]]:
+        """Returns the steps for the question if a question of the same shape was planned before."""
+        key, entities = abstract_question(question)
+        with self._lock:
+            self._check_index(get_symbol_index().fingerprint)
+            steps = self._entries.get(key)
+            if steps is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+        return fill_steps(steps, entities)
+
+    def put(self, question: str, steps: List[dict]) -> bool:
+        """Stores the plan as a template for the question's shape; returns whether it could."""
+        key, entities = abstract_question(question)
+        templated = template_steps(steps, entities)
+        with self._lock:
+            self._check_index(get_symbol_index().fingerprint)
+            if templated is None:
+                self._stats["uncacheable"] += 1
+                return False
+            self._entries[key] = templated
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+            self._stats["stores"] += 1
+            if self.path:
+                try:
+                    self._save()
+                except OSError as e:
+                    print(f"Could not persist the plan cache to {self.path}: {e}")
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {**self._stats, "size": len(self._entries), "hit_rate": self._stats["hits"] / lookups if lookups else 0.0}
@@ -0,0 +1,145 @@
+#Vectorised profit & loss and exposure of the portfolio at current prices
+
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+
+def compute_pnl(columns: Dict[str, np.ndarray], quotes: Dict[str, object], fx_rates: Dict[str, float],
+                base_currency: str = "USD") -> dict:
+    """Joins the holdings columns with current quotes in one pass over all lots.
+
+    `columns` are holdings arrays as produced by `holdings_snapshot.to_columns`, `quotes` maps a
+    symbol to a Finnhub quote (or the error raised fetching it) and `fx_rates` gives the value of
+    one unit of each currency in `base_currency`. Lots whose price or exchange rate is unknown
+    are reported as unpriced and left out of the totals.
+    """
+    symbol, currency = columns["symbol"], columns["currency"]
+    quantity = columns["quantity"].astype(np.float64)
+    purchase_price = columns["purchase_price"].astype(np.float64)
+    if not len(symbol):
+        return {"base_currency": base_currency, "positions": [], "exposure": {}, "totals": _totals(*[np.zeros(0)] * 4), "unpriced": []}
+
+    keys, first, inverse = np.unique(symbol, return_index=True, return_inverse=True)
+    price = np.array([_field(quotes.get(key), "c") for key in keys])
+    prev_close = np.array([_field(quotes.get(key), "pc") for key in keys])
+
+    rates = {base_currency: 1.0, **fx_rates}
+    currency_keys, currency_inverse = np.unique(currency, return_inverse=True)
+    fx = np.array([rates.get(code, np.nan) for code in currency_keys])[currency_inverse]
+
+    # Per lot, in the holding currency and in the base currency.
+    lot_cost = quantity * purchase_price
+    lot_value = quantity * price[inverse]
+    lot_day_change = quantity * (price - prev_close)[inverse]
+    priced = np.isfinite(lot_value) & np.isfinite(fx)
+
+    def per_position(values):
+        return np.bincount(inverse, weights=np.where(priced, values, 0.0), minlength=len(keys))
+
+    position_quantity = np.bincount(inverse, weights=quantity, minlength=len(keys))
+    cost = np.bincount(inverse, weights=lot_cost, minlength=len(keys))
+    value = per_position(lot_value)
+    day_change = per_position(lot_day_change)
+    cost_base = per_position(lot_cost * fx)
+    value_base = per_position(lot_value * fx)
+    day_change_base = per_position(lot_day_change * fx)
+    position_priced = np.bincount(inverse, weights=(~priced).astype(np.float64), minlength=len(keys)) == 0
+    # A position counts only if every one of its lots could be priced.
+    counted = position_priced[inverse]
+
+    pnl = value - cost
+    pnl_base = value_base - cost_base
+    total_value = value_base[position_priced].sum()
+    weight = np.divide(value_base, total_value, out=np.zeros_like(value_base), where=position_priced & (total_value != 0))
+    pnl_pct = np.divide(pnl, cost, out=np.full_like(pnl, np.nan), where=cost != 0)
+    avg_price = np.divide(cost, position_quantity, out=np.full_like(cost, np.nan), where=position_quantity != 0)
+
+    exposure_keys, exposure_inverse = np.unique(currency[counted], return_inverse=True)
+    exposure_value = np.bincount(exposure_inverse, weights=(lot_value * fx)[counted], minlength=len(exposure_keys))
+
+    positions = [
+        {
+            "symbol": str(keys[i]),
+            "currency": str(currency[first[i]]),
+            "quantity": float(position_quantity[i]),
+            "avg_purchase_price": float(avg_price[i]),
+            "current_price": float(price[i]),
+            "previous_close": float(prev_close[i]),
+            "cost": float(cost[i]),
+            "market_value": float(value[i]) if position_priced[i] else None,
+            "unrealised_pnl": float(pnl[i]) if position_priced[i] else None,
+            "unrealised_pnl_pct": float(pnl_pct[i] * 100) if position_priced[i] else None,
+            "day_change": float(day_change[i]) if position_priced[i] else None,
+            "market_value_base": float(value_base[i]) if position_priced[i] else None,
+            "unrealised_pnl_base": float(pnl_base[i]) if position_priced[i] else None,
+            "weight_pct": float(weight[i] * 100) if position_priced[i] else None,
+        }
+        for i in range(len(keys))
+    ]
+    return {
+        "base_currency": base_currency,
+        "positions": positions,
+        "exposure": {
+            str(code): {"market_value_base": float(v), "weight_pct": float(v / total_value * 100) if total_value else 0.0}
+            for code, v in zip(exposure_keys, exposure_value)
+        },
+        "totals": _totals(cost_base[position_priced], value_base[position_priced], pnl_base[position_priced], day_change_base[position_priced]),
+        "unpriced": [str(keys[i]) for i in range(len(keys)) if not position_priced[i]],
+    }
+
+
+def _field(quote, field: str) -> float:
+    if not isinstance(quote, dict) or quote.get(field) is None:
+        return np.nan
+    # Finnhub answers unknown symbols with zeros rather than an error.
+    if field == "c" and not quote[field]:
+        return np.nan
+    return float(quote[field])
+
+
+def _totals(cost, value, pnl, day_change) -> dict:
+    total_cost = float(cost.sum())
+    total_pnl = float(pnl.sum())
+    return {
+        "cost": total_cost,
+        "market_value": float(value.sum()),
+        "unrealised_pnl": total_pnl,
+        "unrealised_pnl_pct": total_pnl / total_cost * 100 if total_cost else 0.0,
+        "day_change": float(day_change.sum()),
+    }
+
+
+def format_pnl(report: dict, symbols: Optional[Iterable[str]] = None) -> str:
+    """Renders the report for the agent, limited to the given symbols if any."""
+    base = report["base_currency"]
+    wanted = set(symbols or [])
+    lines = []
+    for p in report["positions"]:
+        if wanted and p["symbol"] not in wanted:
+            continue
+        if p["market_value"] is None:
+            continue
+        lines.append(
+            f"{p['symbol']}: {p['quantity']:g} shares, avg cost {p['currency']} {p['avg_purchase_price']:.2f}, "
+            f"current price {p['currency']} {p['current_price']:.2f}, market value {p['currency']} {p['market_value']:.2f}, "
+            f"unrealised P&L {p['currency']} {p['unrealised_pnl']:+.2f} ({p['unrealised_pnl_pct']:+.2f}%), "
+            f"today {p['currency']} {p['day_change']:+.2f}, weight {p['weight_pct']:.2f}% of portfolio"
+        )
+    missing = [s for s in wanted if s not in {p["symbol"] for p in report["positions"]}]
+    if missing:
+        lines.append(f"Not held in the portfolio: {', '.join(sorted(missing))}")
+    unpriced = [s for s in report["unpriced"] if not wanted or s in wanted]
+    if unpriced:
+        lines.append(f"Could not price (no quote or exchange rate): {', '.join(unpriced)}")
+
+    t = report["totals"]
+    lines.append(
+        f"Portfolio total ({base}): cost {t['cost']:.2f}, market value {t['market_value']:.2f}, "
+        f"unrealised P&L {t['unrealised_pnl']:+.2f} ({t['unrealised_pnl_pct']:+.2f}%), today {t['day_change']:+.2f}"
+    )
+    if len(report["exposure"]) > 1 or any(code != base for code in report["exposure"]):
+        lines.append("Currency exposure: " + ", ".join(
+            f"{code} {e['weight_pct']:.1f}% ({base} {e['market_value_base']:.2f})" for code, e in report["exposure"].items()
+        ))
+    return "\n".join(lines)
@@ -1,17 +1,45 @@
 #Connects to BQ and retrieves portfolio data
 
-from google.cloud import bigquery
-from vertexai.generative_models import FunctionDeclaration, GenerativeModel, Part, Tool
-from config import PROJECT_ID, BIGQUERY_DATASET_ID
-
-
-sqlGeneratorModel = GenerativeModel(
-    'gemini-1.5-pro',
-    generation_config={"temperature": 0,"max_output_tokens":2048},
-)
-
-
-client = bigquery.Client(project=PROJECT_ID)  # Replace with your project ID
+import re
+import clients
+import scheduler
+import tracing
+from config import PROJECT_ID, BIGQUERY_DATASET_ID, NL2SQL_CACHE_PATH, NL2SQL_CACHE_SIZE
+from config import HOLDINGS_SNAPSHOT, HOLDINGS_REFRESH_SECONDS, HOLDINGS_FULL_REFRESH_SECONDS
+from holdings_snapshot import HoldingsSnapshot, to_columns
+from sql_cache import SQLCache, validate_sql
+from symbols import get_symbol_index, normalize_question
+
+
+#Clients are built on first use (see clients.py); the Google SDK imports are deferred with them
+def _sql_generator_model():
+  from vertexai.generative_models import GenerativeModel
+  return GenerativeModel(
+      'gemini-1.5-pro',
+      generation_config={"temperature": 0,"max_output_tokens":2048},
+  )
+
+
+def _bigquery_client():
+  from google.cloud import bigquery
+  return bigquery.Client(project=PROJECT_ID)  # Replace with your project ID
+
+
+def _holdings_snapshot():
+  snapshot = HoldingsSnapshot(
+    clients.get("bigquery"), HOLDINGS_TABLE,
+    refresh_seconds=HOLDINGS_REFRESH_SECONDS,
+    full_refresh_seconds=HOLDINGS_FULL_REFRESH_SECONDS,
+  )
+  snapshot.start()
+  return snapshot
+
+
+clients.register("sql_generator", _sql_generator_model)
+clients.register("bigquery", _bigquery_client)
+clients.register("nl2sql_cache", lambda: SQLCache(NL2SQL_CACHE_PATH, maxsize=NL2SQL_CACHE_SIZE))
+if HOLDINGS_SNAPSHOT:
+  clients.register("holdings_snapshot", _holdings_snapshot)
 user_question =""
 
 nl2sql_prompt=f"""
@@ -63,32 +91,143 @@ FROM `my-vertexai-project-id.current_portfolio.holdings`;
 """
 
 
-def query_portfolio(prompt):
-  user_question=prompt 
+HOLDINGS_TABLE = f"`{PROJECT_ID}.{BIGQUERY_DATASET_ID}.holdings`"
+
+#Parameterised queries for the questions that make up most of the traffic; these skip SQL generation
+HOLDINGS_SQL = f"""SELECT symbol, company_name, quantity, purchase_price, purchase_date, currency FROM {HOLDINGS_TABLE} ORDER BY symbol, purchase_date"""
+
+POSITION_SQL = f"""SELECT symbol, company_name, currency, SUM(quantity) AS quantity, SAFE_DIVIDE(SUM(quantity * purchase_price), SUM(quantity)) AS avg_purchase_price, MIN(purchase_date) AS first_purchase_date, MAX(purchase_date) AS last_purchase_date, COUNT(*) AS lots FROM {HOLDINGS_TABLE} WHERE symbol IN UNNEST(@symbols) GROUP BY symbol, company_name, currency"""
+
+# Both the user's phrasing and the agent's ("Retrieve the holdings in the portfolio").
+_HOLDINGS_INTENT = re.compile(
+  r"\b(what|which)\b.*\b(hold|holding|own|have|got)\b|\bmy (portfolio|holdings|positions|stocks)\b"
+  r"|\b(retrieve|show|list|get|fetch|display|give|return)\b.*\b(holdings?|portfolio|positions|stocks)\b",
+  re.IGNORECASE,
+)
+_POSITION_INTENT = re.compile(r"\b(pay|paid|bought|buy price|purchase[ds]?|hold|holdings?|own|shares|units|positions?|average|avg|cost|last trade)\b", re.IGNORECASE)
+# Anything that asks for a computation or a filter the templates do not express goes to the LLM,
+# including any time period: the templates add up every lot whatever its purchase date.
+_COMPLEX_INTENT = re.compile(r"\b(total|sum|profit|loss|worth|value|before|after|since|between|more than|less than|most|least|top|largest|smallest|percent|%)\b", re.IGNORECASE)
+_TIME_FILTER = re.compile(
+  r"\b((in|during|of) \d{4}|(19|20)\d{2}|(last|this|past|previous|next) (day|week|month|quarter|year)|when|date[ds]?|today|yesterday|ago|recent(ly)?|ytd"
+  r"|jan(uary)?|feb(ruary)?|mar(ch)?|apr(il)?|may|june?|july?|aug(ust)?|sep(t(ember)?)?|oct(ober)?|nov(ember)?|dec(ember)?|q[1-4])\b",
+  re.IGNORECASE,
+)
+
+
+TEMPLATES = {"holdings": HOLDINGS_SQL, "position": POSITION_SQL}
+
+
+def route_question(question):
+  """Maps a common portfolio question to a template intent and its symbols, or returns None."""
+  if _COMPLEX_INTENT.search(question) or _TIME_FILTER.search(question):
+    return None
+  symbols = get_symbol_index().resolve(question)
+  if symbols and _POSITION_INTENT.search(question):
+    return "position", symbols
+  if not symbols and _HOLDINGS_INTENT.search(question):
+    return "holdings", []
+  return None
+
+
+def query_snapshot(user_question):
+  """Answers from the local snapshot instead of BigQuery; the holdings table is small enough to send whole."""
+  snapshot = clients.get("holdings_snapshot")
+  routed = route_question(user_question)
+  if routed and routed[0] == "position":
+    return snapshot.positions(routed[1])
+  symbols = routed[1] if routed else get_symbol_index().resolve(user_question)
+  return snapshot.rows(symbols)
+
+
+def load_holdings():
+  """Returns every lot of the portfolio as columns, from the snapshot when it is enabled."""
+  if HOLDINGS_SNAPSHOT:
+    return clients.get("holdings_snapshot").ensure_fresh()
+  from google.cloud import bigquery
+  job_config = bigquery.QueryJobConfig(maximum_bytes_billed=100000000)
+  with scheduler.slot("bigquery"), tracing.span("upstream", "bigquery.query", template="holdings") as span:
+    columns = to_columns(clients.get("bigquery").query(HOLDINGS_SQL, job_config=job_config).result())
+    span.set(rows=len(columns["symbol"]))
+  return columns
+
+
+def generate_sql(user_question):
   revised_prompt = "Use these System Instructions: " + nl2sql_prompt + " to answer the provided Question: " + user_question
   print(revised_prompt)
 
-  generated_query=sqlGeneratorModel.generate_content(revised_prompt)
+  with scheduler.slot("vertexai"), tracing.span("upstream", "vertexai.nl2sql") as span:
+    generated_query=clients.get("sql_generator").generate_content(revised_prompt)
+    tracing.record_usage(span, generated_query)
 
   print(generated_query.text)
-  job_config = bigquery.QueryJobConfig(maximum_bytes_billed=100000000)
   cleaned_query = (
         generated_query.text
         .replace("\\n", " ")
         .replace("\n", "")
         .replace("\\", "")
         .replace("```sql", "")
+        .replace("```", "")
     )
+  return cleaned_query
+
+
+def query_bigquery(user_question):
+  from google.cloud import bigquery
+
+  sql_cache = clients.get("nl2sql_cache")
+  cache_key = None
+  generated = False
+  routed = route_question(user_question)
+  if routed:
+    intent, symbols = routed
+    cleaned_query = TEMPLATES[intent]
+    query_parameters = [bigquery.ArrayQueryParameter("symbols", "STRING", symbols)] if symbols else []
+    print(f"Routed to SQL template: {cleaned_query}")
+  else:
+    query_parameters = []
+    cache_key = normalize_question(user_question)
+    cleaned_query = sql_cache.get(cache_key)
+    if cleaned_query:
+      print(f"NL2SQL cache hit: {cleaned_query}")
+    else:
+      cleaned_query = generate_sql(user_question)
+      generated = True
+    # Generated SQL only runs if it is a single read-only query of the holdings table.
+    if not validate_sql(cleaned_query, "holdings"):
+      sql_cache.invalidate(cache_key)
+      raise ValueError(f"Refusing to run generated SQL that is not a read-only query of the holdings table: {cleaned_query}")
+
   print(cleaned_query)
-  query_job = client.query(cleaned_query, job_config=job_config)
-  api_response = query_job.result()
-  api_response = str([dict(row) for row in api_response])
+  job_config = bigquery.QueryJobConfig(maximum_bytes_billed=100000000, query_parameters=query_parameters)
+  try:
+    sql_source = routed[0] if routed else "generated" if generated else "cache"
+    with scheduler.slot("bigquery"), tracing.span("upstream", "bigquery.query", template=sql_source) as span:
+      query_job = clients.get("bigquery").query(cleaned_query, job_config=job_config)
+      api_response = [dict(row) for row in query_job.result()]
+      span.set(rows=len(api_response))
+  except Exception:
+    if cache_key:
+      sql_cache.invalidate(cache_key)
+    raise
+  # Only SQL that was validated and ran successfully is remembered.
+  if generated:
+    sql_cache.put(cache_key, cleaned_query)
+  return api_response
+
+
+def query_portfolio(prompt):
+  user_question=prompt 
+  api_response = query_snapshot(user_question) if HOLDINGS_SNAPSHOT else query_bigquery(user_question)
+  api_response = str(api_response)
   api_response = api_response.replace("\\", "").replace(
     "\n", ""
     )
   print(api_response)
   return_prompt=f"""Generate a natural language response based on the original question: '{user_question}' and the returned results: '{api_response}'"""
   #print(return_prompt)
-  response=sqlGeneratorModel.generate_content(return_prompt)
+  with scheduler.slot("vertexai"), tracing.span("upstream", "vertexai.portfolio_summary") as span:
+    response=clients.get("sql_generator").generate_content(return_prompt)
+    tracing.record_usage(span, response)
   print(response.text)
   return response.text
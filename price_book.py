@@ -0,0 +1,231 @@
+#In-memory price book kept up to date from a streaming trade feed (Finnhub websocket protocol)
+
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+
+class PriceBook:
+    """Last price, previous close and update times of the watched symbols, one array per field.
+
+    Quotes come out in Finnhub's REST shape (`c`, `pc`, `t`), so readers need not care whether a
+    price was streamed or fetched.
+    """
+
+    def __init__(self, capacity: int = 256, clock=time.time):
+        self.clock = clock
+        self._slots: Dict[str, int] = {}
+        self._free: List[int] = []
+        self._lock = threading.Lock()
+        self.price = np.full(capacity, np.nan)
+        self.prev_close = np.full(capacity, np.nan)
+        self.price_at = np.zeros(capacity)
+        self.prev_close_at = np.zeros(capacity)
+
+    def _slot(self, symbol: str) -> int:
+        slot = self._slots.get(symbol)
+        if slot is None and self._free:
+            slot = self._slots[symbol] = self._free.pop()
+        if slot is None:
+            slot = len(self._slots)
+            if slot == len(self.price):
+                for name in ("price", "prev_close", "price_at", "prev_close_at"):
+                    column = getattr(self, name)
+                    grown = np.full(len(column) * 2, np.nan if name in ("price", "prev_close") else 0.0)
+                    grown[:len(column)] = column
+                    setattr(self, name, grown)
+            self._slots[symbol] = slot
+        return slot
+
+    def update_trades(self, symbols: List[str], prices: List[float], timestamps: List[float]):
+        """Applies a batch of trades; timestamps are in seconds. Older trades never overwrite newer ones."""
+        with self._lock:
+            for symbol, price, at in zip(symbols, prices, timestamps):
+                slot = self._slot(symbol)
+                if at >= self.price_at[slot]:
+                    self.price[slot] = price
+                    self.price_at[slot] = at
+
+    def set_quote(self, symbol: str, quote: dict):
+        """Stores a REST quote: its previous close, and its price unless a newer trade was streamed."""
+        now = self.clock()
+        with self._lock:
+            slot = self._slot(symbol)
+            if quote.get("pc"):
+                self.prev_close[slot] = quote["pc"]
+                self.prev_close_at[slot] = now
+            at = float(quote.get("t") or now)
+            if quote.get("c") and at >= self.price_at[slot]:
+                self.price[slot] = quote["c"]
+                self.price_at[slot] = at
+
+    def discard(self, symbols: Iterable[str]):
+        """Forgets the symbols, freeing their slots for others."""
+        with self._lock:
+            for symbol in symbols:
+                slot = self._slots.pop(symbol, None)
+                if slot is not None:
+                    self.price[slot] = self.prev_close[slot] = np.nan
+                    self.price_at[slot] = self.prev_close_at[slot] = 0.0
+                    self._free.append(slot)
+
+    def get_many(self, symbols: Iterable[str], max_age: float, prev_close_max_age: float,
+                 live: Iterable[str] = ()) -> Dict[str, dict]:
+        """Quotes of the symbols that are warm: priced recently (or on a live subscription) with a known previous close."""
+        symbols = list(dict.fromkeys(symbols))
+        live = set(live)
+        now = self.clock()
+        with self._lock:
+            known = [s for s in symbols if s in self._slots]
+            if not known:
+                return {}
+            slots = np.array([self._slots[s] for s in known])
+            price, prev_close = self.price[slots], self.prev_close[slots]
+            price_at, prev_close_at = self.price_at[slots], self.prev_close_at[slots]
+        is_live = np.array([s in live for s in known])
+        warm = (
+            np.isfinite(price) & np.isfinite(prev_close)
+            & ((now - price_at <= max_age) | is_live)
+            & (now - prev_close_at <= prev_close_max_age)
+        )
+        return {
+            known[i]: {"c": float(price[i]), "pc": float(prev_close[i]), "t": int(price_at[i]), "source": "stream"}
+            for i in np.flatnonzero(warm)
+        }
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+
+class PriceFeed:
+    """Background subscriber that streams trades of the watched symbols into a `PriceBook`.
+
+    Speaks the Finnhub websocket protocol (`{"type": "subscribe", "symbol": ...}` out,
+    `{"type": "trade", "data": [{"s", "p", "t"}]}` in), so a local stand-in works for tests. At
+    most `watch_limit` symbols are subscribed: pinned ones (held positions) plus the most recently
+    requested, the least recently requested being dropped first; the book keeps only watched
+    symbols. `pins`, if given, returns the symbols to pin and is called on the feed's thread, so a
+    slow lookup never holds up the caller of `start`. Reconnects with backoff.
+    """
+
+    def __init__(self, book: PriceBook, url: str, token: Optional[str] = None, watch_limit: int = 50,
+                 pins: Optional[Callable[[], Iterable[str]]] = None):
+        self.book = book
+        self.url = url
+        self.token = token
+        self.watch_limit = watch_limit
+        self.pins = pins
+        self.connected = False
+        self._pinned: set = set()
+        self._recent: "OrderedDict[str, None]" = OrderedDict()
+        self._subscribed: set = set()
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ws = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"connects": 0, "messages": 0, "trades": 0, "errors": 0}
+
+    def watched(self) -> set:
+        with self._lock:
+            return set(self._pinned) | set(self._recent)
+
+    def live(self) -> set:
+        """Symbols whose streamed price is current: subscribed on an open connection."""
+        with self._lock:
+            return set(self._subscribed) if self.connected else set()
+
+    def watch(self, symbols: Iterable[str], pin: bool = False):
+        """Adds symbols to the watch list; pinned symbols are never dropped."""
+        dropped = []
+        with self._lock:
+            for symbol in symbols:
+                if pin:
+                    self._pinned.add(symbol)
+                else:
+                    self._recent[symbol] = None
+                    self._recent.move_to_end(symbol)
+            while self._recent and len(self._pinned | set(self._recent)) > self.watch_limit:
+                symbol, _ = self._recent.popitem(last=False)
+                if symbol not in self._pinned:
+                    dropped.append(symbol)
+        self.book.discard(dropped)
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._sync_subscriptions(), self._loop)
+
+    async def _sync_subscriptions(self):
+        ws = self._ws
+        if ws is None:
+            return
+        wanted = self.watched()
+        for symbol in sorted(wanted - self._subscribed):
+            await ws.send(json.dumps({"type": "subscribe", "symbol": symbol}))
+            self._subscribed.add(symbol)
+        for symbol in sorted(self._subscribed - wanted):
+            await ws.send(json.dumps({"type": "unsubscribe", "symbol": symbol}))
+            self._subscribed.discard(symbol)
+
+    def _handle(self, message: str):
+        self.stats["messages"] += 1
+        data = json.loads(message)
+        if data.get("type") != "trade":
+            return
+        # Trades still in flight for an unsubscribed symbol would bring it back into the book.
+        trades = [t for t in data.get("data") or [] if t.get("s") in self._subscribed and t.get("p") is not None]
+        self.stats["trades"] += len(trades)
+        # Finnhub timestamps are in milliseconds.
+        self.book.update_trades([t["s"] for t in trades], [float(t["p"]) for t in trades], [t.get("t", 0) / 1000 for t in trades])
+
+    async def _run(self):
+        import websockets
+
+        url = f"{self.url}?token={self.token}" if self.token else self.url
+        backoff = 1.0
+        while not self._stop.is_set():
+            try:
+                async with websockets.connect(url) as ws:
+                    self._ws, self._subscribed = ws, set()
+                    self.connected = True
+                    self.stats["connects"] += 1
+                    backoff = 1.0
+                    await self._sync_subscriptions()
+                    async for message in ws:
+                        self._handle(message)
+            except Exception as e:
+                self.stats["errors"] += 1
+                # The URL carries the token, so only the kind of error is printed.
+                print(f"Price feed disconnected ({type(e).__name__}), retrying in {backoff:.0f}s")
+            finally:
+                self.connected = False
+                self._ws = None
+            if self._stop.wait(backoff):
+                break
+            backoff = min(backoff * 2, 60.0)
+
+    def start(self):
+        """Runs the subscriber on its own event loop in a daemon thread."""
+        def run():
+            if self.pins is not None:
+                try:
+                    self.watch(self.pins(), pin=True)
+                except Exception as e:
+                    print(f"Price feed starts without the pinned symbols: {e}")
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(self._run())
+            finally:
+                self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="price-feed", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._loop is not None and self._ws is not None:
+            asyncio.run_coroutine_threadsafe(self._ws.close(), self._loop)
@@ -0,0 +1,209 @@
+#Shared, connection-pooled Finnhub quote client with concurrent batch fetching
+
+import asyncio
+import contextvars
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Optional, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+import clients
+import scheduler
+import tracing
+from cache import TTLCache
+from config import FINNHUB_API_KEY, FINNHUB_BASE_URL, QUOTE_MAX_WORKERS, QUOTE_TIMEOUT, QUOTE_CACHE_SIZE, QUOTE_CACHE_TTL
+from config import PRICE_FEED, PRICE_FEED_URL, PRICE_FEED_WATCH_LIMIT, PRICE_FEED_MAX_AGE, PRICE_FEED_PREV_CLOSE_MAX_AGE
+from price_book import PriceBook, PriceFeed
+
+
+QuoteResult = Union[dict, Exception]
+
+
+class QuoteClient:
+    """Finnhub REST client that reuses pooled connections and fetches many symbols at once.
+
+    `base_url` can point at a local HTTP stand-in that serves `/quote?symbol=...`.
+    """
+
+    def __init__(self, api_key: Optional[str] = FINNHUB_API_KEY, base_url: str = FINNHUB_BASE_URL,
+                 max_workers: int = QUOTE_MAX_WORKERS, timeout: float = QUOTE_TIMEOUT):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        # Sent as a header rather than a query parameter so it never shows up in error messages.
+        self.session.headers["X-Finnhub-Token"] = api_key or ""
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="quote")
+
+    def _get_quote(self, symbol: str, timeout: float) -> dict:
+        with tracing.span("upstream", "finnhub.quote", symbol=symbol):
+            response = self.session.get(f"{self.base_url}/quote", params={"symbol": symbol}, timeout=timeout)
+            response.raise_for_status()
+            return response.json()
+
+    def _get_quote_then_release(self, symbol: str, timeout: float, release) -> dict:
+        try:
+            return self._get_quote(symbol, timeout)
+        finally:
+            release()
+
+    def _submit(self, symbol: str, timeout: float, release) -> Future:
+        """Fetches the quote in the pool under an already taken slot, which is given back even if the task never runs."""
+        # Each request runs in a copy of the caller's context so its span nests under the caller's.
+        future = self.executor.submit(contextvars.copy_context().run, self._get_quote_then_release, symbol, timeout, release)
+        future.add_done_callback(lambda f: f.cancelled() and release())
+        return future
+
+    def quote(self, symbol: str, timeout: Optional[float] = None) -> dict:
+        """Fetches the quote of a single symbol."""
+        with scheduler.slot("finnhub"):
+            return self._get_quote(symbol, timeout or self.timeout)
+
+    def candles(self, symbol: str, start: int, end: int, resolution: str = "D", timeout: Optional[float] = None) -> dict:
+        """Fetches the candles of a symbol between two epoch times from `/stock/candle`."""
+        with scheduler.slot("finnhub"), tracing.span("upstream", "finnhub.candle", symbol=symbol):
+            response = self.session.get(
+                f"{self.base_url}/stock/candle",
+                params={"symbol": symbol, "resolution": resolution, "from": start, "to": end},
+                timeout=timeout or self.timeout,
+            )
+            response.raise_for_status()
+            return response.json()
+
+    def quotes(self, symbols: Iterable[str], timeout: Optional[float] = None) -> Dict[str, QuoteResult]:
+        """Fetches the quotes of many symbols concurrently.
+
+        Every symbol gets its own timeout. Symbols that fail or time out map to the exception
+        instead of a quote, so the caller always gets partial results.
+
+        The caller takes each request's `finnhub` slot before handing it to the pool, so the
+        scheduler's priorities decide which caller's requests go next, and workers never sit
+        waiting for a slot. Slots are waited for only until the batch deadline; symbols still
+        without one then time out.
+        """
+        timeout = timeout or self.timeout
+        # Requests enforces the timeout per socket operation; the extra wait bounds the whole batch.
+        deadline = time.monotonic() + timeout * 2
+        futures = {}
+        for symbol in dict.fromkeys(symbols):
+            try:
+                release = scheduler.acquire("finnhub", timeout=_remaining(deadline, symbol))
+            except Exception as e:
+                futures[symbol] = Future()
+                futures[symbol].set_exception(e)
+                continue
+            futures[symbol] = self._submit(symbol, timeout, release)
+        wait(futures.values(), timeout=max(deadline - time.monotonic(), 0))
+        return {symbol: _result(future, symbol) for symbol, future in futures.items()}
+
+    async def aquotes(self, symbols: Iterable[str], timeout: Optional[float] = None) -> Dict[str, QuoteResult]:
+        """Async variant of `quotes` that does not block the event loop."""
+        timeout = timeout or self.timeout
+        deadline = time.monotonic() + timeout * 2
+        futures = {}
+        for symbol in dict.fromkeys(symbols):
+            try:
+                release = await scheduler.aacquire("finnhub", timeout=_remaining(deadline, symbol))
+            except Exception as e:
+                futures[symbol] = asyncio.get_running_loop().create_future()
+                futures[symbol].set_exception(e)
+                continue
+            futures[symbol] = asyncio.wrap_future(self._submit(symbol, timeout, release))
+        if futures:
+            await asyncio.wait(futures.values(), timeout=max(deadline - time.monotonic(), 0))
+        return {symbol: _result(future, symbol) for symbol, future in futures.items()}
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+def _remaining(deadline: float, symbol: str) -> float:
+    """Time left to wait for a slot; raises once the batch deadline has passed."""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError(f"Timed out waiting to fetch the quote for {symbol}")
+    return remaining
+
+
+def _result(future, symbol: str) -> QuoteResult:
+    if not future.done():
+        future.cancel()
+        return TimeoutError(f"Timed out fetching the quote for {symbol}")
+    if future.cancelled():
+        return TimeoutError(f"Cancelled fetching the quote for {symbol}")
+    return future.exception() or future.result()
+
+
+clients.register("quotes", QuoteClient)
+
+
+def get_quote_client() -> QuoteClient:
+    """Returns the process-wide quote client, creating it on first use."""
+    return clients.get("quotes")
+
+
+# Process-wide quote cache shared by every chat session; concurrent lookups of a symbol share one request.
+quote_cache = TTLCache(maxsize=QUOTE_CACHE_SIZE, ttl=QUOTE_CACHE_TTL)
+
+
+def _held_symbols():
+    from portfolio import load_holdings
+    return dict.fromkeys(load_holdings()["symbol"].tolist())
+
+
+def _price_feed() -> PriceFeed:
+    # The holdings come from BigQuery, so they are loaded on the feed's own thread.
+    return PriceFeed(PriceBook(), PRICE_FEED_URL, FINNHUB_API_KEY, PRICE_FEED_WATCH_LIMIT, pins=_held_symbols).start()
+
+
+if PRICE_FEED:
+    clients.register("price_feed", _price_feed)
+
+
+def _from_book(feed: Optional[PriceFeed], symbols) -> Dict[str, QuoteResult]:
+    """Warm quotes from the streamed price book; empty when the feed is off."""
+    if feed is None:
+        return {}
+    return feed.book.get_many(symbols, PRICE_FEED_MAX_AGE, PRICE_FEED_PREV_CLOSE_MAX_AGE, feed.live())
+
+
+def _to_book(feed: Optional[PriceFeed], fetched: Dict[str, QuoteResult]):
+    """Seeds the price book with REST quotes of cold symbols and starts streaming them."""
+    if feed is None:
+        return
+    # Finnhub answers unknown symbols with a zero price; those are not worth streaming.
+    priced = [symbol for symbol, quote in fetched.items() if isinstance(quote, dict) and quote.get("c")]
+    for symbol in priced:
+        feed.book.set_quote(symbol, fetched[symbol])
+    feed.watch(priced)
+
+
+def get_quotes(symbols: Iterable[str]) -> Dict[str, QuoteResult]:
+    """Returns quotes for the symbols from the price book, then the cache, then Finnhub REST."""
+    symbols = list(dict.fromkeys(symbols))
+    feed = clients.get("price_feed") if PRICE_FEED else None
+    quotes = _from_book(feed, symbols)
+    cold = [s for s in symbols if s not in quotes]
+    if cold:
+        fetched = quote_cache.get_many(cold, get_quote_client().quotes)
+        _to_book(feed, fetched)
+        quotes.update(fetched)
+    return {s: quotes[s] for s in symbols}
+
+
+async def aget_quotes(symbols: Iterable[str]) -> Dict[str, QuoteResult]:
+    """Async variant of `get_quotes`."""
+    symbols = list(dict.fromkeys(symbols))
+    feed = await clients.aget("price_feed") if PRICE_FEED else None
+    quotes = _from_book(feed, symbols)
+    cold = [s for s in symbols if s not in quotes]
+    if cold:
+        fetched = await quote_cache.aget_many(cold, get_quote_client().aquotes)
+        _to_book(feed, fetched)
+        quotes.update(fetched)
+    return {s: quotes[s] for s in symbols}
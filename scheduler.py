@@ -0,0 +1,365 @@
+#Process-wide admission control for upstream calls: rate limits, concurrency limits and priorities
+
+import asyncio
+import contextvars
+import functools
+import heapq
+import inspect
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Dict, Optional
+
+import tracing
+from config import SCHEDULER_ENABLED, SCHEDULER_LIMITS, SCHEDULER_MAX_QUEUE, SCHEDULER_MAX_WAIT
+
+
+INTERACTIVE, STANDARD, BATCH = 0, 1, 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", STANDARD: "standard", BATCH: "batch"}
+
+_priority: contextvars.ContextVar = contextvars.ContextVar("falcon_priority", default=STANDARD)
+
+
+class SchedulerBusy(RuntimeError):
+    """Raised instead of queueing when a service's queue is full or the wait would be too long."""
+
+
+class _Waiter:
+    __slots__ = ("priority", "cancelled", "_event", "_loop")
+
+    def __init__(self, priority: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.priority = priority
+        self.cancelled = False
+        self._loop = loop
+        self._event = asyncio.Event() if loop else threading.Event()
+
+    def wake(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._event.set)
+        else:
+            self._event.set()
+
+    def clear(self):
+        self._event.clear()
+
+
+class Service:
+    """Admission control for one upstream service.
+
+    A call is admitted when a token is available in the bucket (refilled at `rate` per second, up
+    to `burst`) and fewer than `concurrency` calls are in flight. Otherwise it queues; the queue
+    is served strictly by priority, first come first served within a priority. When `max_queue`
+    calls are already waiting, or a call has waited `max_wait` seconds, `SchedulerBusy` is raised
+    so callers back off instead of piling up. `acquire(priority, timeout)` gives up sooner when
+    the caller has a shorter deadline of its own.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float, concurrency: int,
+                 max_queue: int = 100, max_wait: float = 60.0, clock=time.monotonic):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.clock = clock
+        self._tokens = burst
+        self._refilled_at = clock()
+        self._active = 0
+        self._queue: list = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._stats = {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0, "wait_s": 0.0, "max_queue_depth": 0}
+
+    # --- Called with the lock held ---
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _head(self) -> Optional[_Waiter]:
+        while self._queue and self._queue[0][2].cancelled:
+            heapq.heappop(self._queue)
+        return self._queue[0][2] if self._queue else None
+
+    def _can_admit(self) -> bool:
+        self._refill()
+        return self._active < self.concurrency and self._tokens >= 1
+
+    def _admit(self):
+        self._tokens -= 1
+        self._active += 1
+        self._stats["admitted"] += 1
+
+    def _next_token_in(self) -> float:
+        return max((1 - self._tokens) / self.rate, 0.001) if self.rate > 0 else 1.0
+
+    def _wake_head(self):
+        head = self._head()
+        if head is not None:
+            head.wake()
+
+    # --- Admission ---
+
+    def _try_enter(self, waiter: Optional[_Waiter]) -> bool:
+        """Admits the call if it is first in line (None: nobody is waiting) and there is capacity."""
+        if (self._head() is waiter) and self._can_admit():
+            if waiter is not None:
+                heapq.heappop(self._queue)
+            self._admit()
+            # Capacity may be left for the next in line.
+            if self._can_admit():
+                self._wake_head()
+            return True
+        return False
+
+    def _enqueue(self, waiter: _Waiter):
+        if len(self._queue) >= self.max_queue:
+            self._stats["rejected"] += 1
+            raise SchedulerBusy(f"{self.name}: {len(self._queue)} calls already waiting")
+        heapq.heappush(self._queue, (waiter.priority, next(self._seq), waiter))
+        self._stats["queued"] += 1
+        self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], len(self._queue))
+
+    def _poll_timeout(self, waiter: _Waiter, deadline: float) -> float:
+        """How long to sleep before checking again: until the next token for the head, else a while."""
+        remaining = deadline - self.clock()
+        if remaining <= 0:
+            return 0
+        wait = self._next_token_in() if self._head() is waiter else 1.0
+        return min(wait, remaining)
+
+    def _give_up(self, waiter: _Waiter, started: float):
+        waiter.cancelled = True
+        self._stats["timed_out"] += 1
+        self._stats["wait_s"] += self.clock() - started
+        self._wake_head()
+
+    def _wait_limit(self, timeout: Optional[float]) -> float:
+        return self.max_wait if timeout is None else max(min(timeout, self.max_wait), 0)
+
+    def acquire(self, priority: int, timeout: Optional[float] = None):
+        with self._lock:
+            if self._try_enter(None):
+                return
+            waiter = _Waiter(priority)
+            self._enqueue(waiter)
+        started = self.clock()
+        limit = self._wait_limit(timeout)
+        deadline = started + limit
+        try:
+            while True:
+                with self._lock:
+                    if self._try_enter(waiter):
+                        self._stats["wait_s"] += self.clock() - started
+                        return
+                    timeout = self._poll_timeout(waiter, deadline)
+                    if timeout <= 0:
+                        self._give_up(waiter, started)
+                        raise SchedulerBusy(f"{self.name}: waited {limit:.1f}s for capacity")
+                    waiter.clear()
+                waiter._event.wait(timeout)
+        except BaseException:
+            with self._lock:
+                if not waiter.cancelled and any(entry[2] is waiter for entry in self._queue):
+                    waiter.cancelled = True
+                    self._wake_head()
+            raise
+
+    async def aacquire(self, priority: int, timeout: Optional[float] = None):
+        with self._lock:
+            if self._try_enter(None):
+                return
+            waiter = _Waiter(priority, asyncio.get_running_loop())
+            self._enqueue(waiter)
+        started = self.clock()
+        limit = self._wait_limit(timeout)
+        deadline = started + limit
+        try:
+            while True:
+                with self._lock:
+                    if self._try_enter(waiter):
+                        self._stats["wait_s"] += self.clock() - started
+                        return
+                    timeout = self._poll_timeout(waiter, deadline)
+                    if timeout <= 0:
+                        self._give_up(waiter, started)
+                        raise SchedulerBusy(f"{self.name}: waited {limit:.1f}s for capacity")
+                    waiter.clear()
+                try:
+                    await asyncio.wait_for(waiter._event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._lock:
+                if not waiter.cancelled and any(entry[2] is waiter for entry in self._queue):
+                    waiter.cancelled = True
+                    self._wake_head()
+            raise
+
+    def release(self):
+        with self._lock:
+            self._active -= 1
+            self._wake_head()
+
+    def stats(self) -> dict:
+        with self._lock:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, _, waiter in self._queue:
+                if not waiter.cancelled:
+                    depth[PRIORITY_NAMES.get(priority, str(priority))] += 1
+            return {**self._stats, "active": self._active, "queue_depth": depth}
+
+
+DEFAULT_LIMITS = {
+    "vertexai": {"rate": 10, "burst": 20, "concurrency": 16},
+    "finnhub": {"rate": 1, "burst": 30, "concurrency": 8},
+    "bigquery": {"rate": 5, "burst": 10, "concurrency": 8},
+    "discoveryengine": {"rate": 2, "burst": 5, "concurrency": 4},
+}
+
+_services: Dict[str, Service] = {}
+_services_lock = threading.Lock()
+
+
+def get_service(name: str) -> Service:
+    service = _services.get(name)
+    if service is None:
+        with _services_lock:
+            if name not in _services:
+                limits = {"rate": 5, "burst": 10, "concurrency": 8, **DEFAULT_LIMITS.get(name, {}), **SCHEDULER_LIMITS.get(name, {})}
+                limits.setdefault("max_queue", SCHEDULER_MAX_QUEUE)
+                limits.setdefault("max_wait", SCHEDULER_MAX_WAIT)
+                _services[name] = Service(name, **limits)
+            service = _services[name]
+    return service
+
+
+def _no_slot():
+    pass
+
+
+def acquire(service: str, timeout: Optional[float] = None) -> Callable[[], None]:
+    """Takes a slot of the service at the current priority and returns the function that gives it back.
+
+    For work handed to a thread pool: take the slot before submitting, so the priority queue
+    rather than the pool's FIFO decides what runs next, and release it when the work is done.
+    Raises `SchedulerBusy` if no slot frees up within `timeout` seconds (or `max_wait`).
+    """
+    if not SCHEDULER_ENABLED:
+        return _no_slot
+    priority = _priority.get()
+    target = get_service(service)
+    with tracing.span("queue", service, priority=PRIORITY_NAMES[priority]):
+        target.acquire(priority, timeout)
+    return target.release
+
+
+async def aacquire(service: str, timeout: Optional[float] = None) -> Callable[[], None]:
+    """Async variant of `acquire`; waiting does not block the event loop."""
+    if not SCHEDULER_ENABLED:
+        return _no_slot
+    priority = _priority.get()
+    target = get_service(service)
+    with tracing.span("queue", service, priority=PRIORITY_NAMES[priority]):
+        await target.aacquire(priority, timeout)
+    return target.release
+
+
+@contextmanager
+def slot(service: str, timeout: Optional[float] = None):
+    """Holds a slot of the service for the duration of the block, waiting for one if needed."""
+    release = acquire(service, timeout)
+    try:
+        yield
+    finally:
+        release()
+
+
+@asynccontextmanager
+async def aslot(service: str, timeout: Optional[float] = None):
+    """Async variant of `slot`; waiting does not block the event loop."""
+    release = await aacquire(service, timeout)
+    try:
+        yield
+    finally:
+        release()
+
+
+@contextmanager
+def priority(level: int):
+    """Runs the block, and every upstream call made from it, at the given priority."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def prioritised(level: int):
+    """Decorator form of `priority`, for sync and async functions alike."""
+    def decorate(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with priority(level):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with priority(level):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class ScheduledChatModel:
+    """Mixin for a LangChain chat model that takes a `vertexai` slot for every call.
+
+    Put it before the model class: `class Model(ScheduledChatModel, ChatVertexAI)`. A streamed
+    call keeps its slot until the stream ends.
+    """
+
+    def _generate(self, *args, **kwargs):
+        with slot("vertexai"):
+            return super()._generate(*args, **kwargs)
+
+    async def _agenerate(self, *args, **kwargs):
+        async with aslot("vertexai"):
+            return await super()._agenerate(*args, **kwargs)
+
+    def _stream(self, *args, **kwargs):
+        with slot("vertexai"):
+            yield from super()._stream(*args, **kwargs)
+
+    async def _astream(self, *args, **kwargs):
+        async with aslot("vertexai"):
+            async for chunk in super()._astream(*args, **kwargs):
+                yield chunk
+
+
+def reset():
+    """Drops every service, so their buckets start full and their counters at zero."""
+    with _services_lock:
+        _services.clear()
+
+
+def stats() -> dict:
+    """Admission counters and current queue depth per service."""
+    with _services_lock:
+        services = list(_services.values())
+    return {service.name: service.stats() for service in services}
+
+
+def _gauges():
+    for name, s in stats().items():
+        yield "falcon_upstream_in_flight", {"service": name}, s["active"]
+        for level, depth in s["queue_depth"].items():
+            yield "falcon_upstream_queue_depth", {"service": name, "priority": level}, depth
+        yield "falcon_upstream_rejected_total", {"service": name}, s["rejected"] + s["timed_out"]
+
+
+tracing.metrics.add_gauges(_gauges)
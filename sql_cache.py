@@ -0,0 +1,68 @@
+#Persistent cache of natural-language questions to SQL that already ran successfully
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+_FORBIDDEN = re.compile(r"\b(insert|update|delete|merge|drop|create|alter|truncate|grant|revoke|call|execute)\b", re.IGNORECASE)
+
+
+def validate_sql(sql: str, table: str) -> bool:
+    """Accepts a single read-only statement that queries the given table (by its unqualified name)."""
+    statement = sql.strip().rstrip(";").strip()
+    if not re.match(r"^(select|with)\b", statement, re.IGNORECASE):
+        return False
+    if ";" in statement or _FORBIDDEN.search(statement):
+        return False
+    return re.search(rf"\b{re.escape(table)}\b", statement, re.IGNORECASE) is not None
+
+
+class SQLCache:
+    """SQLite-backed map of normalised questions to validated SQL, evicting the least recently used."""
+
+    def __init__(self, path: str, maxsize: int = 512):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS nl2sql (question TEXT PRIMARY KEY, sql TEXT NOT NULL, last_used REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.commit()
+
+    def get(self, question: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT sql FROM nl2sql WHERE question = ?", (question,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE nl2sql SET last_used = ?, hits = hits + 1 WHERE question = ?", (time.time(), question)
+            )
+            self._conn.commit()
+            return row[0]
+
+    def put(self, question: str, sql: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO nl2sql (question, sql, last_used, hits) VALUES (?, ?, ?, 0)",
+                (question, sql, time.time()),
+            )
+            self._conn.execute(
+                "DELETE FROM nl2sql WHERE question NOT IN (SELECT question FROM nl2sql ORDER BY last_used DESC LIMIT ?)",
+                (self.maxsize,),
+            )
+            self._conn.commit()
+
+    def invalidate(self, question: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM nl2sql WHERE question = ?", (question,))
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM nl2sql").fetchone()[0]
@@ -0,0 +1,221 @@
+#Local ticker resolution: finds tickers and company names in free text without calling the LLM
+
+import csv
+import hashlib
+import os
+import re
+import threading
+from collections import deque
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from config import SYMBOL_LISTING_PATH
+
+
+BUNDLED_LISTING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "listings.csv")
+
+# A ticker written in capitals (NVDA, BRK.B) or with a cashtag ($nvda).
+_TICKER_TOKEN = re.compile(r"(?<![\w$])\$?[A-Za-z][A-Za-z0-9]*(?:[.\-][A-Za-z]+)?(?!\w)")
+
+
+class SymbolMatch(NamedTuple):
+    symbol: str
+    start: int  # Offsets of the matched text in the original string.
+    end: int
+    text: str
+
+
+def normalize(text: str) -> Tuple[str, List[int]]:
+    """Lowercases the text and turns every run of punctuation/whitespace into one space.
+
+    Returns the normalised string and, for every character in it, its offset in the original text.
+    """
+    chars, offsets = [], []
+    for i, ch in enumerate(text):
+        if ch.isalnum():
+            for low in ch.lower():
+                chars.append(low)
+                offsets.append(i)
+        elif chars and chars[-1] != " ":
+            chars.append(" ")
+            offsets.append(i)
+    if chars and chars[-1] == " ":
+        chars.pop()
+        offsets.pop()
+    return "".join(chars), offsets
+
+
+def _ticker_key(ticker: str) -> str:
+    return re.sub(r"[^A-Z0-9]", "", ticker.upper())
+
+
+class _Automaton:
+    """Aho-Corasick automaton over normalised names; finds every name in one pass over the text."""
+
+    def __init__(self):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[List[Tuple[int, str]]] = [[]]  # (pattern length, symbol)
+
+    def add(self, pattern: str, symbol: str):
+        node = 0
+        for ch in pattern:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            node = nxt
+        if all(length != len(pattern) for length, _ in self.out[node]):
+            self.out[node].append((len(pattern), symbol))
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                fallback = self.fail[node]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[nxt] = self.goto[fallback].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def search(self, text: str) -> Iterable[Tuple[int, int, str]]:
+        """Yields (start, end, symbol) for every name that starts and ends on a word boundary."""
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for length, symbol in self.out[node]:
+                start, end = i - length + 1, i + 1
+                if (start == 0 or text[start - 1] == " ") and (end == len(text) or text[end] == " "):
+                    yield start, end, symbol
+
+
+class SymbolIndex:
+    """Resolves tickers, company names and aliases in free text to ticker symbols.
+
+    Names and aliases match case- and punctuation-insensitively ("at&t", "Coca-Cola"). Bare
+    tickers must be written in capitals or as a cashtag ($tsla), so words like "now" or "low"
+    are not mistaken for tickers; unambiguous lowercase tickers can be listed as aliases. A name
+    also matches without its corporate suffix, unless that leaves a single word ("Target
+    Corporation" is not "target"); such short names have to be listed as aliases.
+    """
+
+    def __init__(self, listings: Iterable[Tuple[str, str, Iterable[str]]]):
+        self.tickers: Dict[str, str] = {}
+        self.names: Dict[str, str] = {}
+        self._automaton = _Automaton()
+        digest = hashlib.sha1()
+        for symbol, name, aliases in listings:
+            symbol = symbol.strip().upper()
+            if not symbol:
+                continue
+            self.tickers[_ticker_key(symbol)] = symbol
+            self.names.setdefault(symbol, name.strip())
+            short = normalize(_strip_suffix(name))[0]
+            # A one-word short name is often an ordinary word ("Target", "Block"), so those come only from aliases.
+            for pattern in (name, short if " " in short else "", *aliases):
+                pattern, _ = normalize(pattern)
+                if pattern:
+                    self._automaton.add(pattern, symbol)
+                    digest.update(f"{pattern}\t{symbol}\n".encode())
+        self._automaton.build()
+        # Identifies what the index matches, e.g. for caches of text abstracted with it.
+        self.fingerprint = digest.hexdigest()
+
+    @classmethod
+    def from_csv(cls, path: str) -> "SymbolIndex":
+        """Loads a listing file with `symbol,name,aliases` columns; aliases are separated by `|`."""
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = [
+                (row["symbol"], row.get("name") or "", [a for a in (row.get("aliases") or "").split("|") if a.strip()])
+                for row in csv.DictReader(f)
+            ]
+        return cls(rows)
+
+    def find(self, text: str) -> List[SymbolMatch]:
+        """Returns the non-overlapping mentions of listed companies, in order of appearance."""
+        candidates = []
+        normalized, offsets = normalize(text)
+        for start, end, symbol in self._automaton.search(normalized):
+            candidates.append((offsets[start], offsets[end - 1] + 1, symbol))
+        for token in _TICKER_TOKEN.finditer(text):
+            word = token.group(0)
+            if not (word.startswith("$") or word.isupper()):
+                continue
+            symbol = self.tickers.get(_ticker_key(word))
+            if symbol:
+                candidates.append((token.start(), token.end(), symbol))
+
+        # Leftmost-longest: a longer mention wins over the shorter ones it contains.
+        candidates.sort(key=lambda c: (c[0], -(c[1] - c[0])))
+        matches, last_end = [], -1
+        for start, end, symbol in candidates:
+            if start >= last_end:
+                matches.append(SymbolMatch(symbol, start, end, text[start:end]))
+                last_end = end
+        return matches
+
+    def resolve(self, text: str) -> List[str]:
+        """Returns the distinct ticker symbols mentioned in the text."""
+        return list(dict.fromkeys(match.symbol for match in self.find(text)))
+
+
+def normalize_question(question: str) -> str:
+    """Canonical form of a question: case, punctuation and company aliases folded away.
+
+    "What did I pay for Tesla?" and "what did i pay for TSLA" share one key.
+    """
+    parts, last = [], 0
+    for match in get_symbol_index().find(question):
+        parts.append(question[last:match.start])
+        parts.append(f" {match.symbol} ")
+        last = match.end
+    parts.append(question[last:])
+    return normalize("".join(parts))[0]
+
+
+_CORPORATE_SUFFIX = re.compile(
+    r"[\s,]+(inc|incorporated|corp|corporation|co|company|plc|p\.l\.c|ltd|limited|group|holdings?|n\.v|s\.a|a/s)\.?$",
+    re.IGNORECASE,
+)
+
+
+def _strip_suffix(name: str) -> str:
+    """Drops trailing corporate suffixes so "Palantir Technologies Inc." also matches "Palantir Technologies"."""
+    previous = None
+    while previous != name:
+        previous, name = name, _CORPORATE_SUFFIX.sub("", name).strip()
+    return re.sub(r"^the\s+", "", name, flags=re.IGNORECASE)
+
+
+_index: Optional[SymbolIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_symbol_index() -> SymbolIndex:
+    """Returns the shared index, loaded on first use from SYMBOL_LISTING_PATH or the bundled listing."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = SymbolIndex.from_csv(SYMBOL_LISTING_PATH or BUNDLED_LISTING_PATH)
+    return _index
+
+
+if __name__ == "__main__":
+    # Ordinary words that are also company names must not turn into tickers.
+    index = get_symbol_index()
+    for question, expected in [
+        ("What is the price target for Nvidia?", ["NVDA"]),
+        ("Any block trades on NVDA?", ["NVDA"]),
+        ("Is my arm position in Shell up?", ["SHEL"]),
+        ("How are Microsoft and Meta Platforms doing?", ["MSFT", "META"]),
+        ("Compare Target Corporation with Block Inc.", ["TGT", "SQ"]),
+    ]:
+        assert index.resolve(question) == expected, (question, index.resolve(question))
+    print("Symbol index checks passed")
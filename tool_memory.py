@@ -0,0 +1,148 @@
+#Results of earlier tool calls in a chat session, reused by follow-up turns while they are fresh
+
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+import tracing
+from config import TOOL_MEMORY, TOOL_MEMORY_MAX_CHARS, TOOL_MEMORY_MAX_ENTRIES, TOOL_MEMORY_MAX_SESSIONS, TOOL_MEMORY_TTLS
+from symbols import normalize_question
+
+
+# Seconds a result stays fresh: quotes move, holdings and analyses much less so.
+DEFAULT_TTLS = {"price_checker": 30, "pnl_calculator": 30, "portfolio_retriever": 300, "stock_analyser": 900, "technical_analyser": 300}
+
+_session: contextvars.ContextVar = contextvars.ContextVar("falcon_session", default=None)
+
+
+class ToolMemory:
+    """Tool results per chat session, keyed by tool and normalised input.
+
+    "What did I pay for Tesla?" and "what did i pay for TSLA" share an entry. A result is reused
+    for its tool's TTL; tools without one are never remembered. Each session keeps at most
+    `max_entries` results and `max_chars` characters, the least recently used going first, and
+    the least recently active sessions are dropped beyond `max_sessions`.
+    """
+
+    def __init__(self, ttls: Dict[str, float], max_entries: int = 64, max_chars: int = 200_000,
+                 max_sessions: int = 256, clock=time.monotonic):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self._sessions: "OrderedDict[str, OrderedDict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "stores": 0, "evictions": 0}
+
+    def get(self, session: str, tool: str, text: str) -> Optional[str]:
+        key = (tool, normalize_question(text))
+        with self._lock:
+            entries = self._sessions.get(session)
+            entry = entries.get(key) if entries is not None else None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            result, stored_at = entry
+            if self.clock() - stored_at > self.ttls.get(tool, 0):
+                self._stats["stale"] += 1
+                del entries[key]
+                return None
+            entries.move_to_end(key)
+            self._sessions.move_to_end(session)
+            self._stats["hits"] += 1
+            return result
+
+    def put(self, session: str, tool: str, text: str, result: str):
+        if not self.ttls.get(tool) or not result or len(result) > self.max_chars:
+            return
+        with self._lock:
+            entries = self._sessions.setdefault(session, OrderedDict())
+            self._sessions.move_to_end(session)
+            entries[(tool, normalize_question(text))] = (result, self.clock())
+            self._stats["stores"] += 1
+            while len(entries) > self.max_entries or sum(len(r) for r, _ in entries.values()) > self.max_chars:
+                entries.popitem(last=False)
+                self._stats["evictions"] += 1
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def forget(self, session: str):
+        with self._lock:
+            self._sessions.pop(session, None)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"] + self._stats["stale"]
+            return {**self._stats, "sessions": len(self._sessions), "hit_rate": self._stats["hits"] / lookups if lookups else 0.0}
+
+
+memory = ToolMemory({**DEFAULT_TTLS, **TOOL_MEMORY_TTLS}, TOOL_MEMORY_MAX_ENTRIES, TOOL_MEMORY_MAX_CHARS, TOOL_MEMORY_MAX_SESSIONS)
+
+
+@contextmanager
+def session(session_id: Optional[str]):
+    """Runs the block, and every tool called from it, as part of the given chat session."""
+    token = _session.set(session_id)
+    try:
+        yield
+    finally:
+        _session.reset(token)
+
+
+def remembered(tool: str, keep: Callable[[str], bool] = bool):
+    """Decorator that reuses the tool's earlier result for the same input in the current session.
+
+    Only results for which `keep(result)` holds are remembered. Outside a session, or with
+    TOOL_MEMORY off, the tool simply runs.
+    """
+    def lookup(text: str) -> Optional[str]:
+        current = _session.get()
+        if not TOOL_MEMORY or current is None:
+            return None
+        result = memory.get(current, tool, text)
+        if result is not None:
+            print(f"Reusing the {tool} result from earlier in the session")
+            tracing.event("cache", "tool_memory_hit", tool=tool)
+        return result
+
+    def store(text: str, result: str):
+        current = _session.get()
+        if TOOL_MEMORY and current is not None and isinstance(result, str) and keep(result):
+            memory.put(current, tool, text, result)
+
+    def decorate(func):
+        # LangChain passes the tool's single argument by name, whatever the function calls it.
+        def text_of(args, kwargs) -> str:
+            return str(args[0] if args else next(iter(kwargs.values()), ""))
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                text = text_of(args, kwargs)
+                result = lookup(text)
+                if result is None:
+                    result = await func(*args, **kwargs)
+                    store(text, result)
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            text = text_of(args, kwargs)
+            result = lookup(text)
+            if result is None:
+                result = func(*args, **kwargs)
+                store(text, result)
+            return result
+        return wrapper
+    return decorate
@@ -1,22 +1,44 @@
-from langchain_core.tools import tool
-from portfolio import query_portfolio
+from langchain_core.tools import StructuredTool, tool
+from portfolio import load_holdings, query_portfolio
+from pnl import compute_pnl, format_pnl
+from indicators import TRADING_DAYS_PER_YEAR, compute_indicators, format_indicators
 from google_grounding import google_ground
 from langchain.prompts import PromptTemplate
-from langchain_google_vertexai import ChatVertexAI
 from langchain.schema import AIMessage
+from quotes import aget_quotes, get_quotes
+from symbols import get_symbol_index
+import asyncio
+import candles
+import clients
+import scheduler
+import tool_memory
 import os
 import json
 import re
-import finnhub
-from config import FINNHUB_API_KEY, LLM_MODEL
+from config import BASE_CURRENCY, FX_RATES, LLM_MODEL
 
 
 
-llm = ChatVertexAI(model_name=LLM_MODEL, temperature=0)
+def _chat_model():
+    from langchain_google_vertexai import ChatVertexAI
+
+    # Every call, from the planner, the agent or a tool, waits for a slot of the shared Vertex AI limits.
+    class ScheduledChatVertexAI(scheduler.ScheduledChatModel, ChatVertexAI):
+        pass
+
+    return ScheduledChatVertexAI(model_name=LLM_MODEL, temperature=0)
+
+
+# Shared with the planner and agent in falcon.py; built on first use.
+clients.register("chat_llm", _chat_model)
 
 
 def get_stock_symbols(prompt: str) -> list:
-    """Uses LLM to extract company names and convert them to ticker symbols."""
+    """Resolves company names and tickers to symbols with the local index, falling back to the LLM."""
+
+    symbols = get_symbol_index().resolve(prompt)
+    if symbols:
+        return symbols
 
     prompt_template = """
     Extract the stock ticker symbols from the given text. If a company name is provided, convert it to its most common ticker symbol. If no symbols or company names are found, return an empty list in valid JSON format.
@@ -44,7 +66,7 @@ def get_stock_symbols(prompt: str) -> list:
     """
 
     PROMPT = PromptTemplate(template=prompt_template, input_variables=["text"])
-    llm_output = llm.invoke(PROMPT.format(text=prompt))
+    llm_output = clients.get("chat_llm").invoke(PROMPT.format(text=prompt))
 
     try:
         if isinstance(llm_output, AIMessage):
@@ -73,8 +95,34 @@ def get_stock_symbols(prompt: str) -> list:
         print(f"An unexpected error occurred: {e}")
         return []
 
-@tool
-def price_checker(prompt: str) -> str:
+def format_quote(ticker_symbol: str, quote) -> str:
+    """Formats a Finnhub quote, or the error raised while fetching it, for the agent."""
+    if isinstance(quote, Exception):
+        return f"An error occurred for {ticker_symbol}: {quote}"
+
+    if not quote or quote.get('c') is None:  # Check if quote and current price exist
+        return f"Could not retrieve price information for {ticker_symbol}. Check the ticker or Finnhub data."
+
+    current_price = quote['c']
+    previous_close = quote.get('pc')  # Use .get to avoid KeyError if 'pc' is missing
+
+    if previous_close is None:
+        return f"Could not retrieve previous close price for {ticker_symbol}."
+
+    change = current_price - previous_close
+    percent_change = (change / previous_close) * 100 if previous_close != 0 else 0 # avoid division by zero
+
+    return f"{ticker_symbol}: Current Price: ${current_price:.2f}, Change: ${change:.2f} ({percent_change:.2f}%)"
+
+
+def _priced(result: str) -> bool:
+    """Whether a price check found every quote; failed lookups are retried on the next turn."""
+    return bool(result) and not result.startswith("No valid") and "error occurred" not in result and "Could not retrieve" not in result
+
+
+@tool_memory.remembered("price_checker", keep=_priced)
+@scheduler.prioritised(scheduler.INTERACTIVE)
+def check_prices(prompt: str) -> str:
     """Check the current price of one or more stocks using Finnhub. Accepts company names or ticker symbols."""
     print("Using Price Checker tool now")
     symbols = get_stock_symbols(prompt)
@@ -83,44 +131,72 @@ def price_checker(prompt: str) -> str:
         print(f"No valid stock symbols or company names found in the input: {prompt}")
         return "No valid stock symbols or company names found in the input."
 
-    results = []
-    client = finnhub.Client(api_key=FINNHUB_API_KEY)
-    for ticker_symbol in symbols:
-        try:
-            print(ticker_symbol)
-            quote = client.quote(ticker_symbol)
-            
-            if not quote or quote['c'] is None:  # Check if quote and current price exist
-                results.append(f"Could not retrieve price information for {ticker_symbol}. Check the ticker or Finnhub data.")
-                continue
+    print(symbols)
+    quotes = get_quotes(symbols)
+    return "\n".join(format_quote(symbol, quote) for symbol, quote in quotes.items())
 
-            current_price = quote['c']
-            previous_close = quote.get('pc')  # Use .get to avoid KeyError if 'pc' is missing
 
-            if previous_close is None:
-                results.append(f"Could not retrieve previous close price for {ticker_symbol}.")
-                continue
+@tool_memory.remembered("price_checker", keep=_priced)
+@scheduler.prioritised(scheduler.INTERACTIVE)
+async def acheck_prices(prompt: str) -> str:
+    """Async variant of `check_prices` that keeps the event loop free while quotes are fetched."""
+    print("Using Price Checker tool now")
+    symbols = await asyncio.to_thread(get_stock_symbols, prompt)
 
-            change = current_price - previous_close
-            percent_change = (change / previous_close) * 100 if previous_close != 0 else 0 # avoid division by zero
+    if not symbols:
+        print(f"No valid stock symbols or company names found in the input: {prompt}")
+        return "No valid stock symbols or company names found in the input."
 
-            results.append(
-                f"{ticker_symbol}: Current Price: ${current_price:.2f}, Change: ${change:.2f} ({percent_change:.2f}%)"
-            )
+    print(symbols)
+    quotes = await aget_quotes(symbols)
+    return "\n".join(format_quote(symbol, quote) for symbol, quote in quotes.items())
 
-        except Exception as e:
-            results.append(f"An error occurred for {ticker_symbol}: {e}")
 
-    return "\n".join(results)
+price_checker = StructuredTool.from_function(
+    func=check_prices,
+    coroutine=acheck_prices,
+    name="price_checker",
+    description=check_prices.__doc__,
+)
 
 @tool
+@tool_memory.remembered("portfolio_retriever")
 def portfolio_retriever(prompt: str) -> str:
-    """Retrieves portfolio information. Information returned must be information on the portfolio. E.g. 100 units of TSLA stock, purchased at an avg price of $200"""
+    """Retrieves portfolio information. Information returned must be information on the portfolio. E.g. 100 units of TSLA stock, purchased at an avg price of $200. Pass the user's question as it was asked."""
     print("Using Portfolio Retriever tool now")
     return query_portfolio(prompt)
 
 
 @tool
+@tool_memory.remembered("pnl_calculator")
+def pnl_calculator(prompt: str) -> str:
+    """Calculates the unrealised profit or loss, market value, daily change and portfolio weight of the holdings at current prices, plus portfolio totals and currency exposure. Mention stocks to focus on them, or ask about the whole portfolio."""
+    print("Using P&L Calculator tool now")
+    symbols = get_symbol_index().resolve(prompt)
+    columns = load_holdings()
+    if not len(columns["symbol"]):
+        return "The portfolio has no holdings."
+    quotes = get_quotes(dict.fromkeys(columns["symbol"].tolist()))
+    report = compute_pnl(columns, quotes, FX_RATES, base_currency=BASE_CURRENCY)
+    return format_pnl(report, symbols)
+
+
+@tool
+@tool_memory.remembered("technical_analyser")
+def technical_analyser(prompt: str) -> str:
+    """Computes technical indicators from daily price history: moving averages (20, 50 and 200 days), trend, RSI, volatility, 1 and 3 month change and drawdown. Handles many stocks in one call; accepts company names or ticker symbols."""
+    print("Using Technical Analyser tool now")
+    symbols = get_stock_symbols(prompt)
+    if not symbols:
+        return "No valid stock symbols or company names found in the input."
+    # A year of trading days covers the 200-day average and the 3 month change.
+    closes, last_times = clients.get("candle_history").closes(symbols, TRADING_DAYS_PER_YEAR + 10)
+    return format_indicators(symbols, compute_indicators(closes), last_times)
+
+
+@tool
+@tool_memory.remembered("stock_analyser")
+@scheduler.prioritised(scheduler.BATCH)
 def stock_analyser(prompt: str) -> str:
     """Analyzes stock market trends."""
     print("Using Stock Analyser tool now")
@@ -128,6 +204,7 @@ def stock_analyser(prompt: str) -> str:
 
 
 @tool
+@scheduler.prioritised(scheduler.INTERACTIVE)
 def normal_responder(qns: str) -> str:
     """Answer normal Question/Generic Question (e.g. Hi or who are you?)"""
     print("Using Normal Responder tool now")
@@ -137,6 +214,6 @@ def normal_responder(qns: str) -> str:
         The user is a day trader, risk tolerance is high. time horizon for trading is usually 1-2 months. Investment goal is to maximise the opportunity cost of the funds and reap maximum returns within the time horizon.
         """,
     PROMPT = PromptTemplate(template=prompt_template, input_variables=["text"])
-    llm_output = llm.invoke(PROMPT.format(qns=qns))
+    llm_output = clients.get("chat_llm").invoke(PROMPT.format(qns=qns))
     return(llm_output.content)
     
@@ -0,0 +1,322 @@
+#Spans for the graph nodes, tools and upstream calls, exported to pluggable sinks
+
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from config import TRACING_SINKS, TRACE_LOG_PATH, METRICS_PORT
+
+
+_sinks: List = []
+_current: contextvars.ContextVar = contextvars.ContextVar("falcon_span", default=None)
+_ids = itertools.count(1)
+
+
+class Span:
+    """One timed operation. `kind` is node, tool, llm or upstream; attributes carry tokens and the like."""
+
+    __slots__ = ("kind", "name", "attributes", "span_id", "parent_id", "trace_id", "started_at", "start", "duration", "status", "error")
+
+    def __init__(self, kind: str, name: str, parent: Optional["Span"] = None, **attributes):
+        self.kind = kind
+        self.name = name
+        self.attributes = attributes
+        self.span_id = next(_ids)
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else self.span_id
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.status = "ok"
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.duration = time.perf_counter() - self.start
+        if error is not None:
+            self.status = "error"
+            self.error = f"{type(error).__name__}: {error}"
+        for sink in list(_sinks):
+            try:
+                sink.emit(self)
+            except Exception as e:
+                print(f"Tracing sink {type(sink).__name__} failed: {e}")
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+            "kind": self.kind, "name": self.name, "started_at": self.started_at,
+            "duration_s": self.duration, "status": self.status, "error": self.error, **self.attributes,
+        }
+
+
+class _NoopSpan:
+    def set(self, **attributes):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+def enabled() -> bool:
+    return bool(_sinks)
+
+
+def add_sink(sink):
+    """Registers a sink; anything with an `emit(span)` method works."""
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+
+def remove_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def start_span(kind: str, name: str, parent: Optional[Span] = None, **attributes) -> Optional[Span]:
+    """Starts a span that the caller finishes; returns None when tracing is off."""
+    if not _sinks:
+        return None
+    return Span(kind, name, parent or _current.get(), **attributes)
+
+
+def event(kind: str, name: str, **attributes):
+    """Records something that happened, as a span without duration."""
+    if _sinks:
+        Span(kind, name, _current.get(), **attributes).finish()
+
+
+@contextmanager
+def span(kind: str, name: str, **attributes):
+    """Times the block as a child of the current span. A no-op when no sink is registered."""
+    if not _sinks:
+        yield _NOOP
+        return
+    current = Span(kind, name, _current.get(), **attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.finish(e)
+        raise
+    else:
+        current.finish()
+    finally:
+        _current.reset(token)
+
+
+def traced(kind: str, name: Optional[str] = None):
+    """Decorator form of `span`, for sync and async functions alike."""
+    def decorate(func):
+        span_name = name or func.__name__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not _sinks:
+                    return await func(*args, **kwargs)
+                with span(kind, span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+            with span(kind, span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def record_usage(current, response):
+    """Copies the token counts of a vertexai `generate_content` response onto the span."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        current.set(input_tokens=getattr(usage, "prompt_token_count", 0), output_tokens=getattr(usage, "candidates_token_count", 0))
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Turns LangChain chat model and tool runs into spans, labelled with the graph node they ran in."""
+
+    # Run in the caller's context so the spans nest under the node that made the call.
+    run_inline = True
+
+    def __init__(self):
+        self._spans: Dict = {}
+
+    def _start(self, run_id, kind: str, name: str, **attributes):
+        started = start_span(kind, name, **attributes)
+        if started is not None:
+            self._spans[run_id] = started
+
+    def _end(self, run_id, error=None, **attributes):
+        started = self._spans.pop(run_id, None)
+        if started is not None:
+            started.set(**attributes)
+            started.finish(error)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node", "other")
+        self._start(run_id, "llm", node, prompt_chars=sum(len(str(m.content)) for batch in messages for m in batch))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        usage = {}
+        try:
+            usage = response.generations[0][0].message.usage_metadata or {}
+        except (AttributeError, IndexError):
+            pass
+        self._end(run_id, input_tokens=usage.get("input_tokens", 0), output_tokens=usage.get("output_tokens", 0))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, name=None, **kwargs):
+        self._start(run_id, "tool", name or (serialized or {}).get("name", "unknown"), input_chars=len(input_str or ""))
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id, output_chars=len(str(output)))
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+
+def callbacks() -> list:
+    """Callbacks to pass in the run config of the workflow; empty when tracing is off."""
+    return [TracingCallbackHandler()] if _sinks else []
+
+
+# --- Sinks ---
+
+class MetricsRegistry:
+    """In-process, Prometheus-style counters and latency histograms per span kind and name."""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series: Dict = {}
+        self._gauges: List = []
+
+    def add_gauges(self, collect):
+        """Adds values read at render time; `collect()` yields `(metric, labels, value)`."""
+        self._gauges.append(collect)
+
+    def emit(self, span: Span):
+        key = (span.kind, span.name)
+        with self._lock:
+            series = self._series.setdefault(key, {
+                "count": 0, "errors": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(self.BUCKETS),
+                "input_tokens": 0, "output_tokens": 0,
+            })
+            series["count"] += 1
+            series["errors"] += span.status != "ok"
+            series["sum"] += span.duration
+            series["max"] = max(series["max"], span.duration)
+            for i, bound in enumerate(self.BUCKETS):
+                if span.duration <= bound:
+                    series["buckets"][i] += 1
+            series["input_tokens"] += span.attributes.get("input_tokens", 0) or 0
+            series["output_tokens"] += span.attributes.get("output_tokens", 0) or 0
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def summary(self) -> dict:
+        """Totals per `kind/name`, e.g. for a benchmark report."""
+        with self._lock:
+            return {
+                f"{kind}/{name}": {
+                    "count": s["count"], "errors": s["errors"], "total_s": s["sum"], "mean_s": s["sum"] / s["count"],
+                    "max_s": s["max"], "input_tokens": s["input_tokens"], "output_tokens": s["output_tokens"],
+                }
+                for (kind, name), s in sorted(self._series.items())
+            }
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines = [
+            "# TYPE falcon_span_seconds histogram",
+        ]
+        with self._lock:
+            series = sorted(self._series.items())
+            for (kind, name), s in series:
+                labels = f'kind="{kind}",name="{name}"'
+                for bound, n in zip(self.BUCKETS, s["buckets"]):
+                    lines.append(f'falcon_span_seconds_bucket{{{labels},le="{bound}"}} {n}')
+                lines.append(f'falcon_span_seconds_bucket{{{labels},le="+Inf"}} {s["count"]}')
+                lines.append(f"falcon_span_seconds_sum{{{labels}}} {s['sum']}")
+                lines.append(f"falcon_span_seconds_count{{{labels}}} {s['count']}")
+            lines.append("# TYPE falcon_span_errors_total counter")
+            for (kind, name), s in series:
+                lines.append(f'falcon_span_errors_total{{kind="{kind}",name="{name}"}} {s["errors"]}')
+            lines.append("# TYPE falcon_tokens_total counter")
+            for (kind, name), s in series:
+                for direction in ("input", "output"):
+                    if s[f"{direction}_tokens"]:
+                        lines.append(f'falcon_tokens_total{{kind="{kind}",name="{name}",direction="{direction}"}} {s[direction + "_tokens"]}')
+        for collect in self._gauges:
+            for metric, labels, value in collect():
+                rendered = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f"{metric}{{{rendered}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int):
+        """Serves `render()` at http://0.0.0.0:<port>/metrics from a daemon thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+
+class JSONLogSink:
+    """Appends one JSON object per finished span to a file."""
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = open(path, "a", buffering=1)
+
+    def emit(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+
+metrics = MetricsRegistry()
+
+if "metrics" in TRACING_SINKS:
+    add_sink(metrics)
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+if "json" in TRACING_SINKS:
+    add_sink(JSONLogSink(TRACE_LOG_PATH))